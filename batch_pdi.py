@@ -0,0 +1,249 @@
+"""
+Geração de diagnósticos em lote (ciclos anuais, times inteiros) sem passar pelo widget.
+
+Para cada email: carrega o contexto da pessoa do banco (mesmo caminho do chat), monta o
+PROMPT_DIAGNOSIS com as infos já registradas (pontos fortes, desenvolvimento, objetivos,
+tarefas) e chama o Flowise com sessionId próprio do lote. Cada resultado vira uma linha
+JSONL; rodar de novo com o mesmo --output pula quem já está com status "ok" (retomável).
+Usa as mesmas variáveis de ambiente do bot (DATABASE_URL, FLOWISE_*...).
+
+Uso:
+    python batch_pdi.py --all --output diagnosticos.jsonl            # todos de pessoas_ativos
+    python batch_pdi.py --emails time.txt --concurrency 8 --rate 2    # um email por linha (ou "email;nome")
+    python batch_pdi.py --all --limit 50 --dry-run                    # só monta os prompts
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import sys
+import time
+from dataclasses import replace
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+BOT_FILE = Path(__file__).with_name("widget_fastapi.py")
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("botapp", str(BOT_FILE))
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader, "Falha ao carregar módulo do BOT"
+    spec.loader.exec_module(module)
+    return module
+
+
+def email_key(email: str) -> str:
+    # só para deduplicar e para o checkpoint: as consultas usam o email exatamente como veio
+    return email.strip().casefold()
+
+
+def _dedup(people: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    seen: Set[str] = set()
+    unique = []
+    for email, nome in people:
+        if email and email_key(email) not in seen:
+            seen.add(email_key(email))
+            unique.append((email, nome))
+    return unique
+
+
+def read_emails(path: str) -> List[Tuple[str, str]]:
+    people = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        email, _, nome = line.replace(",", ";").partition(";")
+        people.append((email.strip(), nome.strip()))
+    return _dedup(people)
+
+
+def query_active_emails(bot) -> List[Tuple[str, str]]:
+    with bot.get_pool(bot.DATABASE_URL).connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT email FROM pessoas_ativos WHERE email IS NOT NULL ORDER BY email")
+        return _dedup([(row[0], "") for row in cur.fetchall()])
+
+
+def read_done(path: Path) -> Set[str]:
+    # checkpoint = o próprio arquivo de saída: quem já tem linha com status "ok" é pulado
+    done: Set[str] = set()
+    if path.exists():
+        for line in path.read_text(encoding="utf-8").splitlines():
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # linha truncada por uma interrupção no meio da escrita
+            if rec.get("status") == "ok":
+                done.add(email_key(rec.get("email") or ""))
+    return done
+
+
+class RateLimiter:
+    """No máximo `rate` inícios por segundo, espaçados (0 = sem limite)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def build_diagnosis_prompt(bot, uctx, nome: str) -> str:
+    valores = uctx.valores
+    # perfil + infos registradas entram como "informações da pessoa"; histórico e resumos vão
+    # nos próprios campos do template (com o orçamento de tokens do bot)
+    perfil = bot.format_profile_context(uctx.email, nome, valores, replace(uctx, historico_bot="", resumos_semanal=""))
+    return bot.build_prompt(
+        "batch_diagnosis", bot.PROMPT_DIAGNOSIS,
+        resumo_pessoa=perfil,
+        feedback=valores.get("output_feedback", "") or "",
+        pontos_fortes=valores.get(bot.INFO_TAGS_PF, ""),
+        pontos_desenvolvimento=valores.get(bot.INFO_TAGS_PD, ""),
+        resultado=valores.get(bot.INFO_TAREFAS, ""),
+        objetivos=valores.get(bot.INFO_OBJETIVOS, ""),
+        historico_bot=uctx.historico_bot or "",
+        resumos_semanal=uctx.resumos_semanal or "",
+    )
+
+
+async def process(bot, email: str, nome: str, args, limiter: RateLimiter) -> Dict:
+    started = time.monotonic()
+    rec: Dict = {"email": email, "at": datetime.now(timezone.utc).isoformat()}
+    try:
+        uctx = await bot.load_user_context(email)
+        if not uctx.ok_db:
+            raise RuntimeError(uctx.msg_db)
+        if uctx.id_pessoa is None:
+            # perfil vazio também vem de uma consulta que falhou: confere direto (levanta em erro de banco)
+            _, _, id_pessoa = await bot.run_db(bot._query_basic_profile, email)
+            if id_pessoa is not None:
+                raise RuntimeError("falha ao carregar o perfil da pessoa")
+            # sem linha em pessoas_ativos (ex.: email com outra grafia): não gera diagnóstico sem dados
+            rec.update(status="no_profile", error="email não encontrado em pessoas_ativos")
+            rec["seconds"] = round(time.monotonic() - started, 3)
+            return rec
+        prompt = build_diagnosis_prompt(bot, uctx, nome)
+        rec["id_pessoa"] = uctx.id_pessoa
+        rec["prompt_tokens"] = bot.estimate_tokens(prompt)
+        if args.dry_run:
+            rec.update(status="dry_run", prompt=prompt)
+        else:
+            await limiter.wait()
+            session_id = f"{uctx.id_pessoa or email}:{date.today().isoformat()}:lote"
+            reply = await bot.call_flowise_with_session(prompt, session_id, nome, email)
+            if bot.is_flowise_error(reply):
+                raise RuntimeError(reply)
+            rec.update(status="ok", diagnostico=reply)
+    except Exception as e:
+        rec.update(status="error", error=str(e) or repr(e))
+    rec["seconds"] = round(time.monotonic() - started, 3)
+    return rec
+
+
+def _pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 2)
+
+
+async def run(bot, people: List[Tuple[str, str]], args) -> Dict:
+    out_path = Path(args.output)
+    done = read_done(out_path) if not args.dry_run else set()
+    todo = [(e, n) for e, n in people if email_key(e) not in done]
+    if args.limit:
+        todo = todo[:args.limit]
+    print(f"[Lote] {len(people)} emails, {len(people) - len(todo)} já concluídos/fora do limite, {len(todo)} a processar")
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in todo:
+        queue.put_nowait(item)
+    limiter = RateLimiter(args.rate)
+    stats = {"ok": 0, "error": 0, "no_profile": 0, "dry_run": 0}
+    latencies: List[float] = []
+    started = time.monotonic()
+    out = open(out_path, "a", encoding="utf-8")
+
+    async def worker():
+        while True:
+            try:
+                email, nome = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            rec = await process(bot, email, nome, args, limiter)
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()  # cada linha gravada é um checkpoint
+            stats[rec["status"]] += 1
+            if rec["status"] == "ok":
+                latencies.append(rec["seconds"])
+            elif rec["status"] in ("error", "no_profile"):
+                print(f"[Lote] {email}: {rec['error']}"[:300])
+            total = sum(stats.values())
+            if total % max(1, args.progress) == 0:
+                print(f"[Lote] {total}/{len(todo)} ({stats['ok']} ok, {stats['error']} erro)")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+    finally:
+        out.close()
+    elapsed = time.monotonic() - started
+    processed = sum(stats.values())
+    return {
+        "processed": processed, **stats, "skipped": len(people) - len(todo),
+        "seconds": round(elapsed, 1),
+        "per_minute": round(processed / elapsed * 60, 1) if elapsed > 0 else None,
+        "latency_p50": _pct(latencies, 0.5), "latency_p95": _pct(latencies, 0.95),
+        "output": str(out_path),
+    }
+
+
+async def amain(args) -> Dict:
+    bot = load_bot()
+    if not bot.DATABASE_URL:
+        sys.exit("DATABASE_URL não configurado")
+    # mesmos recursos do servidor: pools, executor do banco e cliente HTTP do Flowise
+    await bot.app.router.startup()
+    try:
+        if args.emails:
+            people = read_emails(args.emails)
+        else:
+            people = await asyncio.to_thread(query_active_emails, bot)
+        return await run(bot, people, args)
+    finally:
+        await bot.app.router.shutdown()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Gera diagnósticos de PDI em lote")
+    src = p.add_mutually_exclusive_group(required=True)
+    src.add_argument("--emails", help="arquivo com um email por linha (opcional: email;nome)")
+    src.add_argument("--all", action="store_true", help="todas as pessoas de pessoas_ativos")
+    p.add_argument("--output", default="diagnosticos.jsonl", help="JSONL de saída (também é o checkpoint)")
+    p.add_argument("--concurrency", type=int, default=4, help="diagnósticos simultâneos")
+    p.add_argument("--rate", type=float, default=1.0, help="chamadas ao Flowise por segundo (0 = sem limite)")
+    p.add_argument("--limit", type=int, default=0, help="processa no máximo N emails pendentes")
+    p.add_argument("--progress", type=int, default=50, help="mostra o progresso a cada N emails")
+    p.add_argument("--dry-run", action="store_true", help="só monta os prompts (grava com status dry_run)")
+    args = p.parse_args()
+
+    try:
+        result = asyncio.run(amain(args))
+    except KeyboardInterrupt:
+        sys.exit("[Lote] interrompido; rode de novo com o mesmo --output para continuar")
+    print(f"[Lote] {json.dumps(result, ensure_ascii=False)}")
+    sys.exit(1 if result["error"] else 0)
+
+
+if __name__ == "__main__":
+    main()
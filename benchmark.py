@@ -0,0 +1,488 @@
+"""
+Benchmark do bot (carga + latência do caminho quente).
+
+Sobe o `main:app` num processo uvicorn separado, com um Flowise falso (latência,
+streaming e taxa de erro configuráveis) e um PostgreSQL local semeado com
+`pessoas_ativos`, `dados_AVD_pessoas`, `outputs_bot_pessoas` e `resumos`.
+Depois roda conversas completas do ROTEIRO (início → perguntas → diagnóstico → PDI)
+em paralelo e mostra p50/p95/p99 por etapa, RPS e memória (RSS) por worker.
+
+Uso:
+    python benchmark.py                                   # PostgreSQL descartável (pacote pgserver), se instalado
+    python benchmark.py --conversations 200 --concurrency 20 --workers 2
+    python benchmark.py --stream --flowise-latency 2 --flowise-error-rate 0.05
+    python benchmark.py --dsn postgresql://... --dsn-resumo postgresql://...   # banco existente
+    python benchmark.py --db none                         # sem banco: só sessão + Flowise
+    python benchmark.py --json resultado.json             # também grava o relatório em JSON
+
+Com --dsn as tabelas são criadas se não existirem e só as linhas de teste
+(e-mails @benchmark.local) são inseridas e removidas ao final.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+HERE = Path(__file__).resolve().parent
+BENCH_DOMAIN = "benchmark.local"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ================= Flowise falso =================
+FLOWISE_CALLS = [0]  # chamadas recebidas pelo Flowise falso (conferência do regenerate)
+
+
+def start_fake_flowise(port: int, latency: float, jitter: float, token_delay: float, error_rate: float) -> threading.Thread:
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    words = ("Plano de desenvolvimento com atividades práticas, mentorias e cursos alinhados "
+             "às competências escolhidas e aos objetivos de carreira da pessoa. ") * 8
+
+    async def prediction(req: Request):
+        body = await req.json()
+        FLOWISE_CALLS[0] += 1
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if random.random() < error_rate:
+            return JSONResponse({"message": "fake flowise: sobrecarregado"}, status_code=503)
+        text = f"[{len(str(body.get('question', '')))} chars] {words}"
+        if not body.get("streaming"):
+            return JSONResponse({"text": text})
+
+        async def events():
+            yield 'message:\ndata: {"event":"start","data":""}\n\n'
+            for w in text.split(" "):
+                if token_delay:
+                    await asyncio.sleep(token_delay)
+                yield "message:\ndata: " + json.dumps({"event": "token", "data": w + " "}) + "\n\n"
+            yield 'message:\ndata: {"event":"end","data":"[DONE]"}\n\n'
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/api/v1/prediction/{chatflow}", prediction, methods=["POST"])])
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return thread
+
+
+# ================= PostgreSQL =================
+_SCHEMA_MAIN = [
+    "CREATE TABLE IF NOT EXISTS pessoas_ativos (id int, email text, resumo_pessoa text, posicao text)",
+    'CREATE TABLE IF NOT EXISTS "dados_AVD_pessoas" (email text, informacao text, descricao text, data timestamptz)',
+    "CREATE TABLE IF NOT EXISTS outputs_bot_pessoas (email text, data timestamptz, output_pessoa_bot text)",
+]
+_SCHEMA_RESUMO = [
+    'CREATE TABLE IF NOT EXISTS resumos (employee_email text, summary text, "timestamp" timestamptz)',
+]
+_INFOS = ["Tags Pontos Fortes", "tags pontos desenvolvimento", "Objetivos de carreira", "output_feedback", "resumo avd"]
+
+
+def _bench_email(i: int) -> str:
+    return f"bench{i}@{BENCH_DOMAIN}"
+
+
+def _cleanup(dsn: str, dsn_resumo: str):
+    import psycopg2
+    like = f"%@{BENCH_DOMAIN}"
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        for table in ("pessoas_ativos", '"dados_AVD_pessoas"', "outputs_bot_pessoas"):
+            cur.execute(f"DELETE FROM {table} WHERE email LIKE %s", (like,))
+    with psycopg2.connect(dsn_resumo) as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM resumos WHERE employee_email LIKE %s", (like,))
+
+
+def seed_postgres(dsn: str, dsn_resumo: str, people: int):
+    # infos com mais de TEMPO_ATUALIZACAO dias: o roteiro pergunta tudo de novo (pior caso)
+    import psycopg2
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        for stmt in _SCHEMA_MAIN:
+            cur.execute(stmt)
+    with psycopg2.connect(dsn_resumo) as conn, conn.cursor() as cur:
+        for stmt in _SCHEMA_RESUMO:
+            cur.execute(stmt)
+    _cleanup(dsn, dsn_resumo)
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO pessoas_ativos (id, email, resumo_pessoa, posicao) "
+            "SELECT 900000 + g, 'bench' || g || %s, 'Pessoa de benchmark ' || g, 'Analista' "
+            "FROM generate_series(0, %s - 1) g",
+            (f"@{BENCH_DOMAIN}", people),
+        )
+        cur.execute(
+            'INSERT INTO "dados_AVD_pessoas" (email, informacao, descricao, data) '
+            "SELECT 'bench' || g || %s, i, repeat('descrição ' || i || ' ', 20), now() - interval '400 days' "
+            "FROM generate_series(0, %s - 1) g, unnest(%s::text[]) i",
+            (f"@{BENCH_DOMAIN}", people, _INFOS),
+        )
+        cur.execute(
+            "INSERT INTO outputs_bot_pessoas (email, data, output_pessoa_bot) "
+            "SELECT 'bench' || g || %s, now() - (k || ' days')::interval, repeat('saída do bot ', 30) "
+            "FROM generate_series(0, %s - 1) g, generate_series(1, 8) k",
+            (f"@{BENCH_DOMAIN}", people),
+        )
+    with psycopg2.connect(dsn_resumo) as conn, conn.cursor() as cur:
+        cur.execute(
+            'INSERT INTO resumos (employee_email, summary, "timestamp") '
+            "SELECT 'bench' || g || %s, repeat('resumo da semana ' || k || ' ', 15), now() - (k * 3 || ' days')::interval "
+            "FROM generate_series(0, %s - 1) g, generate_series(1, 10) k",
+            (f"@{BENCH_DOMAIN}", people),
+        )
+
+
+def start_pgserver(datadir: str) -> Tuple[Any, str, str]:
+    try:
+        import pgserver
+    except ImportError:
+        raise SystemExit("pacote pgserver não instalado: use `pip install pgserver`, --dsn ou --db none")
+    server = pgserver.get_server(datadir, cleanup_mode="stop")
+    server.psql("CREATE DATABASE resumo;")
+    dsn = server.get_uri()
+    return server, dsn, urlsplit(dsn)._replace(path="/resumo").geturl()
+
+
+# ================= App =================
+def start_app(port: int, workers: int, env: Dict[str, str]) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(workers), "--log-level", "warning"]
+    proc = subprocess.Popen(cmd, cwd=str(HERE), env={**os.environ, **env},
+                            stdout=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"app encerrou na inicialização (código {proc.returncode})")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise SystemExit("app não respondeu /health em 60s")
+
+
+def _rss_by_pid(root_pid: int) -> Dict[int, int]:
+    # RSS (bytes) do processo principal e dos workers do uvicorn
+    try:
+        import psutil
+        root = psutil.Process(root_pid)
+        return {p.pid: p.memory_info().rss for p in [root, *root.children(recursive=True)]}
+    except ImportError:
+        pass
+    except Exception:
+        return {}
+    out = {}
+    proc = Path("/proc")
+    for status in proc.glob("[0-9]*/status"):
+        try:
+            fields = dict(line.split(":", 1) for line in status.read_text().splitlines() if ":" in line)
+        except OSError:
+            continue
+        pid = int(status.parent.name)
+        if pid == root_pid or fields.get("PPid", "").strip() == str(root_pid):
+            out[pid] = int(fields.get("VmRSS", "0 kB").split()[0]) * 1024
+    return out
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid, self.interval = pid, interval
+        self.start_rss: Dict[int, int] = {}
+        self.peak_rss: Dict[int, int] = {}
+        self.last_rss: Dict[int, int] = {}
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.is_set():
+            rss = _rss_by_pid(self.pid)
+            if not self.start_rss:
+                self.start_rss = dict(rss)
+            for pid, value in rss.items():
+                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), value)
+            self.last_rss = rss
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+# ================= Carga =================
+class Stats:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+        self.ttfb: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.conversations_ok = 0
+        self.conversations_failed = 0
+
+    def record(self, stage: str, seconds: float, ok: bool, ttfb: Optional[float] = None):
+        if not ok:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+            return
+        self.latency.setdefault(stage, []).append(seconds)
+        if ttfb is not None:
+            self.ttfb.setdefault(stage, []).append(ttfb)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[idx]
+
+
+async def _send(client: httpx.AsyncClient, payload: Dict[str, Any], stream: bool) -> Tuple[bool, str, float, Optional[float]]:
+    started = time.perf_counter()
+    if not stream:
+        resp = await client.post("/api/message", json=payload)
+        ok = resp.status_code == 200
+        reply = resp.json().get("reply", "") if ok else ""
+        return ok and "(Flowise indisponível)" not in reply, reply, time.perf_counter() - started, None
+    parts: List[str] = []
+    first: Optional[float] = None
+    async with client.stream("POST", "/api/message/stream", json=payload) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            return False, "", time.perf_counter() - started, None
+        async for line in resp.aiter_lines():
+            if line.startswith("data:"):
+                text = json.loads(line[5:]).get("text", "")
+                if text:
+                    if first is None:
+                        first = time.perf_counter() - started
+                    parts.append(text)
+    reply = "".join(parts)
+    return "(Flowise indisponível)" not in reply, reply, time.perf_counter() - started, first
+
+
+async def conversation(client: httpx.AsyncClient, idx: int, args, run_id: str, stats: Stats):
+    base = {
+        "user_id": f"bench-{run_id}-{idx}",
+        "user_name": f"Pessoa {idx}",
+        "user_email": _bench_email(idx % args.people),
+        "regenerate": not args.allow_prompt_cache,
+    }
+    try:
+        ok, reply, secs, ttfb = await _send(client, {**base, "text": "1"}, args.stream)
+        stats.record("start", secs, ok, ttfb)
+        if not ok:
+            stats.conversations_failed += 1
+            return
+        for step in range(6):  # 4 perguntas no máximo; a última resposta dispara o diagnóstico
+            # texto único por conversa: conversas simultâneas da mesma pessoa não caem na mesma geração
+            ok, reply, secs, ttfb = await _send(client, {**base, "text": f"Resposta de benchmark {idx}.{step}: " + "contexto " * 20}, args.stream)
+            stage = "diagnosis" if "Diagnóstico inicial" in reply else "roteiro"
+            stats.record(stage, secs, ok, ttfb)
+            if not ok:
+                stats.conversations_failed += 1
+                return
+            if stage == "diagnosis":
+                break
+        else:
+            stats.conversations_failed += 1
+            return
+        ok, reply, secs, ttfb = await _send(client, {**base, "text": "Comunicação; Planejamento"}, args.stream)
+        stats.record("pdi", secs, ok, ttfb)
+        if ok:
+            stats.conversations_ok += 1
+        else:
+            stats.conversations_failed += 1
+    except Exception as e:
+        stats.errors["exception"] = stats.errors.get("exception", 0) + 1
+        stats.conversations_failed += 1
+        if args.verbose:
+            print(f"conversa {idx}: {e!r}")
+
+
+async def drive(base_url: str, args) -> Tuple[Stats, float]:
+    stats = Stats()
+    run_id = uuid.uuid4().hex[:8]
+    sem = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+        async def one(i: int):
+            async with sem:
+                await conversation(client, i, args, run_id, stats)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(args.conversations)))
+        return stats, time.perf_counter() - started
+
+
+# ================= Relatório =================
+def build_report(stats: Stats, elapsed: float, mem: Optional[MemorySampler], args) -> Dict[str, Any]:
+    stages = {}
+    for stage in ("start", "roteiro", "diagnosis", "pdi"):
+        values = stats.latency.get(stage, [])
+        stages[stage] = {
+            "ok": len(values), "errors": stats.errors.get(stage, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 1), "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "mean_ms": round(sum(values) / len(values) * 1000, 1) if values else 0.0,
+        }
+        if stage in stats.ttfb:
+            stages[stage]["ttfb_p50_ms"] = round(percentile(stats.ttfb[stage], 50) * 1000, 1)
+            stages[stage]["ttfb_p95_ms"] = round(percentile(stats.ttfb[stage], 95) * 1000, 1)
+    requests = sum(len(v) for v in stats.latency.values()) + sum(stats.errors.values())
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("dsn", "dsn_resumo")},
+        "elapsed_s": round(elapsed, 2),
+        "requests": requests,
+        "rps": round(requests / elapsed, 2) if elapsed else 0.0,
+        "conversations_ok": stats.conversations_ok,
+        "conversations_failed": stats.conversations_failed,
+        "conversations_per_s": round(stats.conversations_ok / elapsed, 2) if elapsed else 0.0,
+        "stages": stages,
+        "errors": stats.errors,
+        "flowise_calls": FLOWISE_CALLS[0],
+    }
+    if not args.allow_prompt_cache:
+        # com regenerate, toda geração (início, diagnóstico, PDI) tem de chegar ao Flowise;
+        # menos chamadas que isso = respostas reaproveitadas e latências que não medem nada
+        generations = sum(stages[s]["ok"] for s in ("start", "diagnosis", "pdi"))
+        report["flowise_calls_expected_min"] = generations
+        report["regenerate_ok"] = FLOWISE_CALLS[0] >= generations
+    if mem is not None:
+        report["memory_mb"] = {
+            str(pid): {"start": round(mem.start_rss.get(pid, 0) / 2**20, 1), "peak": round(peak / 2**20, 1),
+                       "end": round(mem.last_rss.get(pid, 0) / 2**20, 1)}
+            for pid, peak in sorted(mem.peak_rss.items())
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    print()
+    print(f"Conversas: {report['conversations_ok']} ok / {report['conversations_failed']} com falha "
+          f"em {report['elapsed_s']}s  ({report['conversations_per_s']} conversas/s)")
+    print(f"Requisições: {report['requests']}  ({report['rps']} req/s)")
+    print()
+    header = f"{'etapa':<10} {'ok':>6} {'erros':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'média ms':>9}"
+    has_ttfb = any("ttfb_p50_ms" in s for s in report["stages"].values())
+    if has_ttfb:
+        header += f" {'ttfb p50':>9} {'ttfb p95':>9}"
+    print(header)
+    for stage, s in report["stages"].items():
+        line = (f"{stage:<10} {s['ok']:>6} {s['errors']:>6} {s['p50_ms']:>9} {s['p95_ms']:>9} "
+                f"{s['p99_ms']:>9} {s['mean_ms']:>9}")
+        if has_ttfb:
+            line += f" {s.get('ttfb_p50_ms', '-'):>9} {s.get('ttfb_p95_ms', '-'):>9}"
+        print(line)
+    if report.get("memory_mb"):
+        print()
+        print("Memória (RSS, MB) por processo do uvicorn:")
+        for pid, m in report["memory_mb"].items():
+            print(f"  pid {pid}: início {m['start']}  pico {m['peak']}  fim {m['end']}")
+    if report["errors"]:
+        print()
+        print(f"Erros: {report['errors']}")
+    if report.get("regenerate_ok") is False:
+        print()
+        print(f"ATENÇÃO: {report['flowise_calls']} chamadas ao Flowise para {report['flowise_calls_expected_min']} "
+              "gerações com regenerate — respostas foram reaproveitadas sem chamar o Flowise")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Benchmark do bot PDI (conversas completas do roteiro)")
+    p.add_argument("--conversations", type=int, default=50, help="conversas completas a executar")
+    p.add_argument("--concurrency", type=int, default=10, help="conversas simultâneas")
+    p.add_argument("--workers", type=int, default=1, help="workers do uvicorn")
+    p.add_argument("--stream", action="store_true", help="usa /api/message/stream (mede também o 1º token)")
+    p.add_argument("--allow-prompt-cache", action="store_true", help="não manda regenerate (cache de respostas ativo)")
+    p.add_argument("--timeout", type=float, default=300, help="timeout de cada requisição (s)")
+    p.add_argument("--flowise-latency", type=float, default=0.5, help="latência do Flowise falso (s)")
+    p.add_argument("--flowise-jitter", type=float, default=0.1, help="variação aleatória da latência (s)")
+    p.add_argument("--flowise-token-delay", type=float, default=0.0, help="pausa entre tokens no streaming (s)")
+    p.add_argument("--flowise-error-rate", type=float, default=0.0, help="fração de respostas 503 do Flowise falso")
+    p.add_argument("--db", choices=("pgserver", "none"), default="pgserver", help="banco local (ignorado com --dsn)")
+    p.add_argument("--dsn", help="PostgreSQL existente (DATABASE_URL)")
+    p.add_argument("--dsn-resumo", help="PostgreSQL dos resumos semanais (padrão: o mesmo de --dsn)")
+    p.add_argument("--people", type=int, default=200, help="pessoas semeadas no banco")
+    p.add_argument("--keep-data", action="store_true", help="não remove as linhas de teste do --dsn ao final")
+    p.add_argument("--json", help="grava o relatório neste arquivo")
+    p.add_argument("--verbose", action="store_true")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    tmp = tempfile.TemporaryDirectory(prefix="bench-pdi-")
+    flowise_port, app_port = _free_port(), _free_port()
+    start_fake_flowise(flowise_port, args.flowise_latency, args.flowise_jitter, args.flowise_token_delay,
+                       args.flowise_error_rate)
+
+    pg = None
+    dsn = dsn_resumo = ""
+    if args.dsn:
+        dsn, dsn_resumo = args.dsn, args.dsn_resumo or args.dsn
+    elif args.db == "pgserver":
+        pg, dsn, dsn_resumo = start_pgserver(os.path.join(tmp.name, "pg"))
+    if dsn:
+        print(f"Semeando {args.people} pessoas...")
+        seed_postgres(dsn, dsn_resumo, args.people)
+
+    env = {
+        "FLOWISE_PREDICTION_URL": f"http://127.0.0.1:{flowise_port}/api/v1/prediction/bench",
+        "DATABASE_URL": dsn,
+        "DATABASE_URL_RESUMO_SEMANAL": dsn_resumo,
+        "PROMPT_CACHE_PATH": os.path.join(tmp.name, "prompt_cache.db"),
+        "TRACE_EXPORT": "",
+        # sessões em memória são por processo: com vários workers a conversa precisa de um store comum
+        "SESSION_BACKEND": "memory" if args.workers == 1 else "sqlite",
+        "SESSION_SQLITE_PATH": os.path.join(tmp.name, "sessions.db"),
+    }
+    app = start_app(app_port, args.workers, env)
+    mem = MemorySampler(app.pid)
+    mem.start()
+    try:
+        print(f"Rodando {args.conversations} conversas ({args.concurrency} simultâneas, {args.workers} worker(s))...")
+        stats, elapsed = asyncio.run(drive(f"http://127.0.0.1:{app_port}", args))
+    finally:
+        mem.stop()
+        os.killpg(app.pid, signal.SIGTERM)
+        try:
+            app.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(app.pid, signal.SIGKILL)
+        if args.dsn and not args.keep_data:
+            _cleanup(dsn, dsn_resumo)
+        if pg is not None:
+            pg.cleanup()
+        tmp.cleanup()
+
+    report = build_report(stats, elapsed, mem, args)
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    sys.exit(1 if stats.conversations_ok == 0 or report.get("regenerate_ok") is False else 0)
+
+
+if __name__ == "__main__":
+    main()
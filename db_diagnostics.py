@@ -0,0 +1,77 @@
+"""
+Diagnóstico das consultas do bot no PostgreSQL.
+
+Roda EXPLAIN (ANALYZE, BUFFERS) em cada consulta do caminho do chat (perfil, últimas infos,
+infos em lote, histórico do bot, resumos semanais) para um email de amostra, mostra tempo,
+blocos lidos e seq scans, e confere se os índices recomendados existem. Com --create-indexes,
+cria os que faltam (CREATE INDEX CONCURRENTLY IF NOT EXISTS). Usa as mesmas variáveis de
+ambiente do bot (DATABASE_URL, DATABASE_URL_RESUMO_SEMANAL, DB_SCHEMA/DB_TABLE...).
+
+Uso:
+    python db_diagnostics.py                         # email de amostra: 1º de pessoas_ativos
+    python db_diagnostics.py --email fulano@x.com --plans
+    python db_diagnostics.py --create-indexes
+    python db_diagnostics.py --json                  # relatório completo em JSON
+"""
+import argparse
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+BOT_FILE = Path(__file__).with_name("widget_fastapi.py")
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("botapp", str(BOT_FILE))
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader, "Falha ao carregar módulo do BOT"
+    spec.loader.exec_module(module)
+    return module
+
+
+def print_report(report):
+    print(f"Email de amostra: {report['email'] or '(nenhum)'}\n")
+    print(f"{'consulta':<20} {'ms':>9} {'planej.':>8} {'hit':>7} {'read':>7}  seq scans")
+    for name, q in report["queries"].items():
+        if "error" in q:
+            print(f"{name:<20} ERRO {q['error']}")
+            continue
+        seq = ", ".join(q["seq_scans"]) or "-"
+        print(f"{name:<20} {q['ms']:>9.3f} {q['planning_ms']:>8.3f} {q['shared_hit_blocks']:>7} {q['shared_read_blocks']:>7}  {seq}")
+        if q.get("plan"):
+            print(json.dumps(q["plan"], indent=2, ensure_ascii=False, default=str))
+    print("\nÍndices recomendados:")
+    for idx in report["indexes"]:
+        status = "ERRO " + idx["error"] if "error" in idx else "criado" if idx.get("created") else "ok" if idx["exists"] else "FALTA"
+        print(f"  [{status}] {idx['table']} ({', '.join(idx['columns'])})")
+        if status == "FALTA":
+            print(f"      {idx['ddl']};")
+    if report.get("missing_indexes"):
+        print("\nSeq scan em tabela pequena é normal; em tabelas grandes, crie os índices acima (--create-indexes).")
+
+
+def main():
+    p = argparse.ArgumentParser(description="EXPLAIN das consultas do bot PDI e índices recomendados")
+    p.add_argument("--email", default=None, help="email de amostra (padrão: 1º de pessoas_ativos)")
+    p.add_argument("--plans", action="store_true", help="mostra o plano completo de cada consulta")
+    p.add_argument("--create-indexes", action="store_true", help="cria os índices recomendados que faltam")
+    p.add_argument("--json", action="store_true", help="imprime o relatório em JSON")
+    args = p.parse_args()
+
+    bot = load_bot()
+    try:
+        report = bot.db_diagnostics(args.email, create=args.create_indexes, with_plans=args.plans)
+    finally:
+        bot.close_pools()
+    if not report.get("queries") and not report.get("ok"):
+        sys.exit(report.get("msg", "falha no diagnóstico"))
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=str))
+    else:
+        print_report(report)
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
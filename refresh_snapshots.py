@@ -0,0 +1,58 @@
+"""
+Atualiza os snapshots de contexto (perfil + últimas infos + histórico + resumos semanais)
+usados pelo chat quando SNAPSHOTS=1.
+
+Só recalcula quem teve linhas alteradas nas tabelas de origem desde a última rodada
+(ou cujo snapshot passou de SNAPSHOT_REBUILD_AGE). Usa as mesmas variáveis de ambiente
+do bot (DATABASE_URL, DATABASE_URL_RESUMO_SEMANAL, SNAPSHOT_PATH...).
+
+Uso:
+    python refresh_snapshots.py                 # uma rodada incremental (ex.: cron a cada 5 min)
+    python refresh_snapshots.py --full          # recalcula todos
+    python refresh_snapshots.py --loop 300      # fica rodando, uma rodada a cada 300 s
+"""
+import argparse
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+BOT_FILE = Path(__file__).with_name("widget_fastapi.py")
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location("botapp", str(BOT_FILE))
+    module = importlib.util.module_from_spec(spec)
+    assert spec and spec.loader, "Falha ao carregar módulo do BOT"
+    spec.loader.exec_module(module)
+    return module
+
+
+def main():
+    p = argparse.ArgumentParser(description="Atualiza os snapshots de contexto do bot PDI")
+    p.add_argument("--full", action="store_true", help="recalcula todos, mesmo sem mudança (com --loop, só na 1ª rodada)")
+    p.add_argument("--loop", type=float, default=0, help="repete a cada N segundos (0 = uma rodada)")
+    p.add_argument("--path", default=None, help="arquivo SQLite dos snapshots (padrão: SNAPSHOT_PATH)")
+    args = p.parse_args()
+
+    bot = load_bot()
+    if not bot.DATABASE_URL:
+        sys.exit("DATABASE_URL não configurado")
+    store = bot.SnapshotStore(args.path or bot.SNAPSHOT_PATH, bot.SNAPSHOT_MAX_AGE)
+    full = args.full
+    try:
+        while True:
+            result = bot.refresh_snapshots(store, full=full)
+            full = False  # com --loop, só a primeira rodada é completa
+            if not args.loop:
+                sys.exit(0 if result.get("ok") and not result.get("failed") else 1)
+            time.sleep(args.loop)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+        bot.close_pools()
+
+
+if __name__ == "__main__":
+    main()
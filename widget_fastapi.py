@@ -1,11 +1,18 @@
 from fastapi import FastAPI, Query
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
+from starlette.datastructures import MutableHeaders
 from pathlib import Path
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Tuple, Dict, Any
-import os, re, unicodedata, json
+from typing import Optional, Tuple, Dict, Any, List, AsyncIterator, Awaitable, Callable, Iterator, Union
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+from dataclasses import dataclass, asdict
+from email.utils import parsedate_to_datetime
+from abc import ABC, abstractmethod
+import os, re, unicodedata, json, asyncio, threading, time, secrets, copy, hashlib, random, contextvars, gzip, zlib
 import httpx
 import psycopg2
 from psycopg2.extras import RealDictCursor
@@ -26,23 +33,120 @@ DATABASE_URL = os.getenv("DATABASE_URL", "")
 DATABASE_URL_RESUMO_SEMANAL = os.getenv("DATABASE_URL_RESUMO_SEMANAL", "")
 DB_SCHEMA = os.getenv("DB_SCHEMA", "")
 DB_TABLE = os.getenv("DB_TABLE", "")
+INFO_TABLE_REFRESH = int(os.getenv("INFO_TABLE_REFRESH", 0))  # s; 0 = descobre a tabela uma vez por processo
+DB_COMBINED_QUERY = os.getenv("DB_COMBINED_QUERY", "1").lower() in ("1", "true", "yes")  # perfil+infos+histórico em 1 consulta
+
+# Pool de conexões (um por banco: DATABASE_URL e DATABASE_URL_RESUMO_SEMANAL)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 5))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))          # espera máx. por conexão livre (s)
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 10))       # handshake TCP/TLS (s)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0))  # 0 = sem limite
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 8))   # threads para consultas síncronas
+DB_EXECUTOR_QUEUE = int(os.getenv("DB_EXECUTOR_QUEUE", 32))      # consultas aguardando thread; acima disso, "ocupado"
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", 30))        # tempo máx. de cada consulta vista pela rota (s)
+DB_BULK_ITERSIZE = int(os.getenv("DB_BULK_ITERSIZE", 2000))       # linhas por ida ao servidor nas consultas em lote
+DB_BULK_MAX_EMAILS = int(os.getenv("DB_BULK_MAX_EMAILS", 500))    # emails por chamada em POST /profiles
+
+# Cliente HTTP do Flowise (um por worker, reaproveita conexões)
+FLOWISE_MAX_CONNECTIONS = int(os.getenv("FLOWISE_MAX_CONNECTIONS", 20))   # teto de requests simultâneos ao Flowise
+FLOWISE_MAX_KEEPALIVE = int(os.getenv("FLOWISE_MAX_KEEPALIVE", 10))
+FLOWISE_KEEPALIVE_EXPIRY = float(os.getenv("FLOWISE_KEEPALIVE_EXPIRY", 30))
+FLOWISE_POOL_TIMEOUT = float(os.getenv("FLOWISE_POOL_TIMEOUT", 30))       # espera por conexão livre (s)
+FLOWISE_HTTP2 = os.getenv("FLOWISE_HTTP2", "0").lower() in ("1", "true", "yes")
+FLOWISE_TIMEOUT = float(os.getenv("FLOWISE_TIMEOUT", 120))               # leitura da resposta do diagnóstico/PDI (s)
+FLOWISE_RETRIES = int(os.getenv("FLOWISE_RETRIES", 2))                    # novas tentativas só em 429/5xx/erro de conexão
+FLOWISE_RETRY_BASE = float(os.getenv("FLOWISE_RETRY_BASE", 1.0))          # backoff exponencial com jitter (s)
+FLOWISE_RETRY_MAX_DELAY = float(os.getenv("FLOWISE_RETRY_MAX_DELAY", 20))
+# geração marcada como em andamento na sessão há mais que isso é dada como perdida (cliente caiu, worker reiniciou)
+GENERATION_PENDING_TTL = float(os.getenv("GENERATION_PENDING_TTL",
+                                         (FLOWISE_TIMEOUT + FLOWISE_RETRY_MAX_DELAY) * (FLOWISE_RETRIES + 1)))
+FLOWISE_BREAKER_FAILURES = int(os.getenv("FLOWISE_BREAKER_FAILURES", 5))  # falhas seguidas que abrem o circuito (0 = desliga)
+FLOWISE_BREAKER_COOLDOWN = float(os.getenv("FLOWISE_BREAKER_COOLDOWN", 30))
+FLOWISE_CONCURRENCY = int(os.getenv("FLOWISE_CONCURRENCY", 10))          # gerações simultâneas no Flowise (0 = sem teto)
+FLOWISE_PER_USER = int(os.getenv("FLOWISE_PER_USER", 1))                  # gerações simultâneas por usuário
+FLOWISE_QUEUE_MAX = int(os.getenv("FLOWISE_QUEUE_MAX", 100))              # gerações aguardando vaga; acima disso, recusa
+FLOWISE_QUEUE_TIMEOUT = float(os.getenv("FLOWISE_QUEUE_TIMEOUT", 60))     # espera máx. por vaga (s)
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv("SINGLEFLIGHT_RESULT_TTL", 300))  # s que uma geração concluída fica reaproveitável
+
+# Cache persistente de respostas do diagnóstico/PDI (SQLite local)
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE", "1").lower() in ("1", "true", "yes")
+PROMPT_CACHE_PATH = os.getenv("PROMPT_CACHE_PATH", str(Path(__file__).with_name("prompt_cache.db")))
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", 7 * 24 * 3600))
+PROMPT_CACHE_MAX_MB = int(os.getenv("PROMPT_CACHE_MAX_MB", 100))
+
+# Tracing: TRACE_EXPORT=jsonl (arquivo) ou otlp (coletor OpenTelemetry via HTTP/JSON); vazio = desligado
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", str(Path(__file__).with_name("traces.jsonl")))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "bot-pdi")
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", 2))
+TRACE_BUFFER_MAX = int(os.getenv("TRACE_BUFFER_MAX", 10000))  # spans aguardando exportação (descarta os mais antigos)
+
+# Modo job: geração em background com consulta por GET /api/jobs/{id}
+JOB_MODE = os.getenv("JOB_MODE", "0").lower() in ("1", "true", "yes")  # padrão de /api/message quando o payload não diz
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", 100))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 3600))  # s que o resultado fica disponível
+
+# Cache de perfil por email (TTL em segundos por fonte; 0 desliga a fonte)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 5000))
+CACHE_TTL_PERFIL = int(os.getenv("CACHE_TTL_PERFIL", 3600))        # pessoas_ativos
+CACHE_TTL_INFOS = int(os.getenv("CACHE_TTL_INFOS", 600))           # dados_AVD_pessoas
+CACHE_TTL_HISTORICO = int(os.getenv("CACHE_TTL_HISTORICO", 600))   # outputs_bot_pessoas
+CACHE_TTL_RESUMOS = int(os.getenv("CACHE_TTL_RESUMOS", 3600))      # resumos
+
+# Snapshots de contexto pré-calculados (refresh_snapshots.py ou atualização em background)
+SNAPSHOTS_ENABLED = os.getenv("SNAPSHOTS", "0").lower() in ("1", "true", "yes")
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", str(Path(__file__).with_name("context_snapshots.db")))
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", 3600))            # s sem confirmação → chat volta às consultas ao vivo
+SNAPSHOT_REBUILD_AGE = float(os.getenv("SNAPSHOT_REBUILD_AGE", 6 * 3600))  # recalcula mesmo sem mudança (janelas em dias)
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", 0))  # s; 0 = só via refresh_snapshots.py
+CACHE_STALE = int(os.getenv("CACHE_STALE", 3600))                  # serve vencido enquanto atualiza
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")                         # header X-Admin-Token das rotas /admin
+
+# Sessões do roteiro: memory (1 worker), sqlite (workers na mesma máquina) ou redis (várias réplicas)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_TTL = int(os.getenv("SESSION_TTL", 24 * 3600))                 # inatividade (s)
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000))     # teto LRU do backend memory
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", 60))  # 0 = sem limpeza em background
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", str(Path(__file__).with_name("sessions.db")))
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_REDIS_TIMEOUT = float(os.getenv("SESSION_REDIS_TIMEOUT", 2))     # s por comando (conexão + resposta)
 
 # Janelas (dias)
 DELTA_TEMPO_RESUMO = int(os.getenv("DELTA_TEMPO_RESUMO", 30))
 DELTA_TEMPO = int(os.getenv("DELTA_TEMPO", 90))
 TEMPO_ATUALIZACAO = int(os.getenv("TEMPO_ATUALIZACAO", 180))
 
+# Orçamento dos prompts (tokens estimados por caracteres; 0 = sem limite)
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", 8000))                   # teto do prompt inteiro
+PROMPT_RESUMOS_MAX_TOKENS = int(os.getenv("PROMPT_RESUMOS_MAX_TOKENS", 3000))   # resumos semanais (os mais recentes ficam)
+PROMPT_HISTORICO_MAX_TOKENS = int(os.getenv("PROMPT_HISTORICO_MAX_TOKENS", 800))  # histórico de interações com o bot
+PROMPT_RESUMO_CLIP_CHARS = int(os.getenv("PROMPT_RESUMO_CLIP_CHARS", 240))      # semanas antigas que não cabem inteiras
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", 4))
+
 # Valores padrão (fallback)
 DEFAULT_USER_ID = "131"
 DEFAULT_USER_NAME = "Lucas Chieregatti Machado"
 DEFAULT_USER_EMAIL = "lucas@mindsight.com.br"
 
+WIDGET_MAX_AGE = int(os.getenv("WIDGET_MAX_AGE", 300))  # s de cache do HTML do widget no navegador/CDN
+
+# Compressão das respostas (gzip; brotli se o pacote estiver instalado)
+COMPRESS_ENABLED = os.getenv("COMPRESS", "1").lower() in ("1", "true", "yes")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 500))       # bytes; respostas menores vão sem compressão
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BR_QUALITY = int(os.getenv("COMPRESS_BR_QUALITY", 5))
+COMPRESS_SSE = os.getenv("COMPRESS_SSE", "1").lower() in ("1", "true", "yes")  # comprime /api/message/stream (com flush por token)
+
 # ================= App =================
 app = FastAPI(title="Bot PDI – FastAPI + Flowise + PostgreSQL")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
     allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
 @app.middleware("http")
@@ -51,6 +155,136 @@ async def add_security_headers(request: Request, call_next):
     resp.headers.setdefault("Content-Security-Policy", "frame-ancestors *")
     return resp
 
+# ================= Compressão =================
+# gzip/brotli das respostas (ASGI puro). Respostas de corpo único abaixo de COMPRESS_MIN_SIZE
+# passam direto; respostas em streaming (SSE) são comprimidas pedaço a pedaço com flush,
+# para cada token continuar chegando na hora.
+try:
+    import brotli  # opcional: pip install brotli
+except ImportError:
+    brotli = None
+
+_COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def _accepted_encodings(header: str) -> List[str]:
+    accepted = []
+    for part in header.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        if name and not re.search(r"q\s*=\s*0(\.0*)?\s*$", params):
+            accepted.append(name)
+    return accepted
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=COMPRESS_BR_QUALITY)
+        else:
+            self._gz = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.flush()
+        return self._gz.compress(data) + self._gz.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._br.finish()
+        return self._gz.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        accepted = _accepted_encodings(accept)
+        encoding = "br" if brotli is not None and "br" in accepted else "gzip" if "gzip" in accepted else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict[str, Any]] = None
+        compressor: Optional[_StreamCompressor] = None
+        buffered: Optional[List[bytes]] = None  # tamanho conhecido, mas chegando em pedaços (BaseHTTPMiddleware)
+        passthrough = False
+
+        async def wrapped_send(message):
+            nonlocal start, compressor, buffered, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if buffered is not None:
+                buffered.append(body)
+                if not more:
+                    data = compressor.chunk(b"".join(buffered)) + compressor.finish()
+                    MutableHeaders(raw=start["headers"])["Content-Length"] = str(len(data))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": data})
+                return
+            if compressor is not None:
+                data = compressor.chunk(body) if body else b""
+                if not more:
+                    data += compressor.finish()
+                if data or not more:
+                    await send({"type": "http.response.body", "body": data, "more_body": more})
+                return
+
+            headers = MutableHeaders(raw=start["headers"])
+            ctype = headers.get("content-type", "")
+            length = headers.get("content-length")
+            size = int(length) if length and length.isdigit() else (None if more else len(body))
+            if (
+                "content-encoding" in headers
+                or start["status"] < 200 or start["status"] in (204, 304)
+                or not ctype.startswith(_COMPRESSIBLE_TYPES)
+                or (size is not None and size < COMPRESS_MIN_SIZE)
+                or (size is None and ctype.startswith("text/event-stream") and not COMPRESS_SSE)
+            ):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            headers["Content-Encoding"] = encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag  # corpo diferente do original: ETag fraco
+            compressor = _StreamCompressor(encoding)
+            if size is not None:
+                if more:
+                    buffered = [body]
+                    return
+                data = compressor.chunk(body) + compressor.finish()
+                headers["Content-Length"] = str(len(data))
+                await send(start)
+                await send({"type": "http.response.body", "body": data})
+                return
+            del headers["content-length"]
+            await send(start)
+            await send({"type": "http.response.body", "body": compressor.chunk(body), "more_body": True})
+
+        await self.app(scope, receive, wrapped_send)
+
+
+if COMPRESS_ENABLED:
+    app.add_middleware(CompressionMiddleware)
+
 # ================= Frontend =================
 INDEX_HTML = r"""
 <!doctype html>
@@ -302,7 +536,14 @@ INDEX_HTML = r"""
     <script>
       const $ = (sel) => document.querySelector(sel);
       const messagesEl = $('#messages');
-      const user = { id: "__USER_ID__", name: "__USER_NAME__", email: "__USER_EMAIL__" };
+      // identidade vem da URL do iframe (?user_id=&user_name=&user_email=): o HTML é o mesmo para todos
+      const DEFAULT_USER = __DEFAULT_USER__;
+      const qs = new URLSearchParams(location.search);
+      const user = {
+        id: qs.get('user_id') || DEFAULT_USER.id,
+        name: qs.get('user_name') || DEFAULT_USER.name,
+        email: qs.get('user_email') || DEFAULT_USER.email,
+      };
 
       function timeNow(){ 
         const d = new Date(); 
@@ -327,23 +568,86 @@ INDEX_HTML = r"""
           .replaceAll("'",'&#039;'); 
       }
 
+      // Balão do bot preenchido aos poucos (streaming)
+      function addStreamingMessage(){
+        const div = document.createElement('div');
+        div.className = 'msg bot';
+        const body = document.createElement('span');
+        body.textContent = '…';
+        const time = document.createElement('time');
+        time.textContent = timeNow();
+        div.appendChild(body);
+        div.appendChild(time);
+        messagesEl.appendChild(div);
+        messagesEl.scrollTop = messagesEl.scrollHeight;
+        autoResize();
+        let started = false;
+        return {
+          append(chunk){
+            if(!started){ body.textContent = ''; started = true; }
+            body.textContent += chunk;
+            messagesEl.scrollTop = messagesEl.scrollHeight;
+            autoResize();
+          },
+          started: () => started,
+          remove: () => div.remove(),
+        };
+      }
+
       async function sendMessage(text){
+        const payload = JSON.stringify({ 
+          text,
+          user_id: user.id,
+          user_name: user.name,
+          user_email: user.email
+        });
+        const bubble = addStreamingMessage();
+        let rid = '';
         try{
-          const res = await fetch('/api/message', { 
+          const res = await fetch('/api/message/stream', { 
             method: 'POST', 
-            headers: { 'Content-Type': 'application/json' }, 
-            body: JSON.stringify({ 
-              text,
-              user_id: user.id,
-              user_name: user.name,
-              user_email: user.email
-            }) 
+            headers: { 'Content-Type': 'application/json', 'Accept': 'text/event-stream' }, 
+            body: payload
           });
-          if(!res.ok) throw new Error('Falha no envio');
-          const data = await res.json();
-          addMessage(data.reply || `Ok!`, 'bot');
+          rid = res.headers.get('X-Request-ID') || '';
+          if(res.status === 503){
+            const data = await res.json();
+            bubble.append(data.reply || 'Tente novamente em alguns segundos.');
+            return;
+          }
+          if(!res.ok || !res.body) throw new Error('Falha no envio');
+          const reader = res.body.getReader();
+          const decoder = new TextDecoder();
+          let buf = '';
+          for(;;){
+            const { value, done } = await reader.read();
+            if(done) break;
+            buf += decoder.decode(value, { stream: true });
+            let idx;
+            while((idx = buf.indexOf('\n\n')) >= 0){
+              const frame = buf.slice(0, idx);
+              buf = buf.slice(idx + 2);
+              let event = 'message', data = '';
+              for(const line of frame.split('\n')){
+                if(line.startsWith('event:')) event = line.slice(6).trim();
+                else if(line.startsWith('data:')) data += line.slice(5).trim();
+              }
+              if(event === 'token' && data){
+                bubble.append(JSON.parse(data).text || '');
+              }
+            }
+          }
+          if(!bubble.started()) bubble.append('Ok!');
         }catch(err){ 
-          addMessage('Ops! Não consegui responder agora.', 'bot'); 
+          // id de correlação: permite achar a requisição nos logs/traces do servidor
+          if(rid) console.warn('Falha na requisição', rid, err);
+          const ref = rid ? `ref. ${rid.slice(0, 8)}` : '';
+          if(bubble.started()){
+            bubble.append(ref ? `\n\n(conexão interrompida — ${ref})` : '\n\n(conexão interrompida)');
+          } else {
+            bubble.remove();
+            addMessage(ref ? `Ops! Não consegui responder agora. (${ref})` : 'Ops! Não consegui responder agora.', 'bot'); 
+          }
         }
       }
 
@@ -418,6 +722,503 @@ def normalize_text(s: str) -> str:
     s = re.sub(r"[^a-z0-9 ]+", " ", s)
     return re.sub(r"\s+", " ", s).strip()
 
+# ================= Tracing =================
+# Spans por requisição (HTTP → turno → consultas → Flowise), encadeados por contextvar.
+# Exporta em lote para um arquivo JSONL ou para um coletor OTLP/HTTP (JSON).
+_CURRENT_SPAN: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_REQUEST_ID: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="")
+_SPAN_BUFFER: deque = deque(maxlen=TRACE_BUFFER_MAX)
+_TRACE_FLUSHER: Optional[asyncio.Task] = None
+_OTLP_CLIENT: Optional[httpx.AsyncClient] = None  # um cliente só para o exportador (keep-alive com o coletor)
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{8,64}$")
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start": self.start_ns / 1e9, "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+                "attributes": self.attributes, "error": self.error}
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    if not TRACE_EXPORT:
+        yield None
+        return
+    parent = _CURRENT_SPAN.get()
+    sp = Span(name, parent.trace_id if parent else secrets.token_hex(16), parent.span_id if parent else None, attributes)
+    token = _CURRENT_SPAN.set(sp)
+    try:
+        yield sp
+    except Exception as e:
+        sp.error = repr(e)
+        raise
+    finally:
+        sp.end_ns = time.time_ns()
+        try:
+            _CURRENT_SPAN.reset(token)
+        except ValueError:
+            pass  # gerador fechado em outro contexto
+        _SPAN_BUFFER.append(sp)
+
+
+def set_span_attr(key: str, value: Any):
+    sp = _CURRENT_SPAN.get()
+    if sp is not None:
+        sp.set(key, value)
+
+
+def request_id() -> str:
+    return _REQUEST_ID.get()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_payload(spans: List[Span]) -> Dict[str, Any]:
+    out = []
+    for sp in spans:
+        item = {
+            "traceId": sp.trace_id, "spanId": sp.span_id, "name": sp.name, "kind": 1,
+            "startTimeUnixNano": str(sp.start_ns), "endTimeUnixNano": str(sp.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in sp.attributes.items()],
+            "status": {"code": 2, "message": sp.error} if sp.error else {"code": 1},
+        }
+        if sp.parent_id:
+            item["parentSpanId"] = sp.parent_id
+        out.append(item)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "widget_fastapi"}, "spans": out}],
+    }]}
+
+
+def _write_jsonl(spans: List[Span]):
+    with open(TRACE_FILE, "a", encoding="utf-8") as fh:
+        for sp in spans:
+            fh.write(json.dumps(sp.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+
+def _otlp_client() -> httpx.AsyncClient:
+    global _OTLP_CLIENT
+    if _OTLP_CLIENT is None or _OTLP_CLIENT.is_closed:
+        _OTLP_CLIENT = httpx.AsyncClient(timeout=5.0, limits=httpx.Limits(max_connections=2))
+    return _OTLP_CLIENT
+
+
+async def flush_spans():
+    spans: List[Span] = []
+    while _SPAN_BUFFER:
+        spans.append(_SPAN_BUFFER.popleft())
+    if not spans:
+        return
+    try:
+        if TRACE_EXPORT == "otlp":
+            resp = await _otlp_client().post(TRACE_OTLP_ENDPOINT, json=_otlp_payload(spans))
+            if resp.status_code >= 400:
+                print(f"[Tracing] Coletor OTLP respondeu HTTP {resp.status_code}")
+        else:
+            await asyncio.to_thread(_write_jsonl, spans)
+    except Exception as e:
+        print(f"[Tracing] Falha ao exportar {len(spans)} spans: {e!r}")
+
+
+async def _flush_spans_forever():
+    while True:
+        await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+        await flush_spans()
+
+
+@app.on_event("startup")
+async def _startup_tracing():
+    global _TRACE_FLUSHER
+    if TRACE_EXPORT:
+        if TRACE_EXPORT not in ("jsonl", "otlp"):
+            raise RuntimeError(f"TRACE_EXPORT inválido: {TRACE_EXPORT!r} (use jsonl ou otlp)")
+        if TRACE_EXPORT == "otlp":
+            _otlp_client()
+        _TRACE_FLUSHER = asyncio.create_task(_flush_spans_forever())
+
+
+@app.on_event("shutdown")
+async def _shutdown_tracing():
+    global _TRACE_FLUSHER, _OTLP_CLIENT
+    if _TRACE_FLUSHER is not None:
+        _TRACE_FLUSHER.cancel()
+        _TRACE_FLUSHER = None
+    if TRACE_EXPORT:
+        await flush_spans()
+    if _OTLP_CLIENT is not None:
+        await _OTLP_CLIENT.aclose()
+        _OTLP_CLIENT = None
+
+
+# ================= Métricas (Prometheus) =================
+# Contadores/histogramas em memória do processo, expostos em texto no GET /metrics.
+# Com vários workers do uvicorn cada um tem os seus (o Prometheus soma por instância).
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], le: Optional[str] = None) -> str:
+    parts = [f'{n}="{_escape_label(str(v))}"' for n, v in zip(names, values)]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        out += [f"{self.name}{_fmt_labels(self.labels, k)} {v:g}" for k, v in items]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = _LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # contagens por bucket + [soma, total]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *labels: str):
+        key = tuple(str(v) for v in labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            for bound, count in zip(self.buckets, row):
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, format(bound, 'g'))} {count:g}")
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, '+Inf')} {row[-1]:g}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {row[-2]:.6f}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {row[-1]:g}")
+        return out
+
+
+class Gauge:
+    # valor lido na hora da coleta: collect() devolve [(valores dos labels, valor), ...]
+    TYPE = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], collect: Callable[[], List[Tuple[Tuple[str, ...], float]]]):
+        self.name, self.help, self.labels, self.collect = name, help, labels, collect
+        METRICS.append(self)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        try:
+            samples = self.collect()
+        except Exception as e:
+            print(f"[Métricas] Falha ao coletar {self.name}: {e!r}")
+            samples = []
+        out += [f"{self.name}{_fmt_labels(self.labels, tuple(str(v) for v in k))} {float(v):g}" for k, v in samples]
+        return out
+
+
+class CollectedCounter(Gauge):
+    # contador mantido por outro objeto (ex.: expirações do SessionStore), lido na coleta
+    TYPE = "counter"
+
+
+METRICS: List[Any] = []
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUESTS = Counter("pdi_http_requests_total", "Requisições HTTP por rota e status", ("method", "route", "status"))
+HTTP_SECONDS = Histogram("pdi_http_request_seconds", "Latência das rotas HTTP até o início da resposta", ("method", "route"))
+TURN_SECONDS = Histogram("pdi_turn_seconds", "Duração do turno da conversa por etapa do fluxo", ("route", "stage"))
+DB_SECONDS = Histogram("pdi_db_query_seconds", "Latência das consultas ao PostgreSQL por helper", ("helper",))
+DB_ERRORS = Counter("pdi_db_query_errors_total", "Consultas ao PostgreSQL com erro por helper", ("helper",))
+DB_REJECTED = Counter("pdi_db_rejected_total", "Consultas recusadas (executor cheio) ou abandonadas por timeout", ("reason",))
+FLOWISE_SECONDS = Histogram("pdi_flowise_request_seconds", "Latência de cada tentativa de chamada ao Flowise", ("mode",))
+FLOWISE_RESPONSES = Counter("pdi_flowise_responses_total", "Tentativas de chamada ao Flowise por resultado (status HTTP ou erro)", ("mode", "status"))
+FLOWISE_RETRIES_TOTAL = Counter("pdi_flowise_retries_total", "Novas tentativas de chamada ao Flowise", ("reason",))
+FLOWISE_ADMISSION_WAIT = Histogram("pdi_flowise_admission_wait_seconds", "Espera por vaga no controle de admissão do Flowise")
+PROMPT_TOKENS = Histogram("pdi_prompt_tokens", "Tamanho estimado (tokens) dos prompts enviados ao Flowise", ("kind",),
+                          buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
+
+_TURN_STAGE: contextvars.ContextVar[str] = contextvars.ContextVar("turn_stage", default="menu")
+
+
+def set_turn_stage(stage: str):
+    _TURN_STAGE.set(stage)
+    set_span_attr("turn.stage", stage)
+
+
+@app.middleware("http")
+async def observe_http(request: Request, call_next):
+    # correlation id: reaproveita o X-Request-ID do cliente (se válido) e devolve no header
+    incoming = request.headers.get("x-request-id", "")
+    rid = incoming if _REQUEST_ID_RE.match(incoming) else secrets.token_hex(16)
+    _REQUEST_ID.set(rid)
+    started = time.perf_counter()
+    status = 500
+    with span("http.request", **{"http.method": request.method, "request.id": rid}) as sp:
+        try:
+            resp = await call_next(request)
+            status = resp.status_code
+            resp.headers["X-Request-ID"] = rid
+            return resp
+        finally:
+            route = request.scope.get("route")
+            path = getattr(route, "path", None) or "other"  # template da rota (sem ids) para não explodir labels
+            HTTP_REQUESTS.inc(request.method, path, status)
+            HTTP_SECONDS.observe(time.perf_counter() - started, request.method, path)
+            if sp is not None:
+                sp.set("http.route", path)
+                sp.set("http.status_code", status)
+
+
+# ================= Pool PostgreSQL =================
+class DBPoolTimeout(Exception):
+    pass
+
+
+class PgPool:
+    """Pool limitado de conexões psycopg2, seguro para uso a partir de threads."""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float):
+        self.dsn = dsn
+        self.minconn = max(0, min(minconn, maxconn))
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self._idle: List[Any] = []
+        self._in_use = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._closed = False
+
+    def _connect(self):
+        kwargs: Dict[str, Any] = {"connect_timeout": DB_CONNECT_TIMEOUT}
+        if DB_STATEMENT_TIMEOUT_MS > 0:
+            kwargs["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        return psycopg2.connect(self.dsn, **kwargs)
+
+    def open(self):
+        # pré-aquece `minconn` conexões para o primeiro request não pagar o handshake
+        while len(self._idle) < self.minconn:
+            conn = self._connect()
+            with self._lock:
+                self._idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        if self._closed:
+            raise RuntimeError("pool fechado")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise DBPoolTimeout(f"pool esgotado ({self.maxconn} conexões ocupadas por {self.timeout:.0f}s)")
+        conn = None
+        try:
+            with self._lock:
+                self._in_use += 1
+                while self._idle and conn is None:
+                    conn = self._idle.pop()
+                    if conn.closed:
+                        conn = None
+            if conn is None:
+                conn = self._connect()
+            with conn:  # commit ao sair, rollback em caso de exceção
+                yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+                reuse = conn is not None and not conn.closed and not self._closed
+                if reuse:
+                    self._idle.append(conn)
+            if conn is not None and not reuse:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"in_use": self._in_use, "idle": len(self._idle), "max": self.maxconn}
+
+
+_POOLS: Dict[str, PgPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(dsn: str) -> PgPool:
+    pool = _POOLS.get(dsn)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(dsn)
+            if pool is None:
+                pool = PgPool(dsn, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+                _POOLS[dsn] = pool
+    return pool
+
+
+def open_pools():
+    for dsn in (DATABASE_URL, DATABASE_URL_RESUMO_SEMANAL):
+        if not dsn:
+            continue
+        try:
+            get_pool(dsn).open()
+        except Exception as e:
+            print(f"[DB] Falha ao pré-aquecer pool: {e}")
+
+
+def close_pools():
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+# Executor dedicado às consultas: psycopg2 é síncrono, então cada consulta roda numa
+# thread própria sem travar o event loop. Fila limitada: acima dela, DBBusy na hora.
+class DBBusy(Exception):
+    pass
+
+
+_DB_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_DB_PENDING = 0  # em execução + aguardando thread
+_DB_PENDING_LOCK = threading.Lock()
+
+
+def _db_executor() -> ThreadPoolExecutor:
+    global _DB_EXECUTOR
+    if _DB_EXECUTOR is None:
+        _DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _DB_EXECUTOR
+
+
+def _db_release(_fut=None):
+    global _DB_PENDING
+    with _DB_PENDING_LOCK:
+        _DB_PENDING -= 1
+
+
+async def run_db(fn, *args):
+    global _DB_PENDING
+    with _DB_PENDING_LOCK:
+        if _DB_PENDING >= DB_EXECUTOR_WORKERS + DB_EXECUTOR_QUEUE:
+            DB_REJECTED.inc("busy")
+            raise DBBusy(f"{_DB_PENDING} consultas em andamento/na fila")
+        _DB_PENDING += 1
+    try:
+        # copia o contexto para a thread: spans do banco ficam pendurados no span da requisição
+        cf = _db_executor().submit(contextvars.copy_context().run, _timed_db_call, fn, *args)
+    except BaseException:
+        _db_release()
+        raise
+    # libera a vaga só quando a thread termina de fato (mesmo após timeout do lado async)
+    cf.add_done_callback(_db_release)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(cf), DB_CALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        DB_REJECTED.inc("timeout")
+        raise
+
+
+def _timed_db_call(fn, *args):
+    helper = getattr(fn, "__name__", "query").lstrip("_")
+    started = time.perf_counter()
+    try:
+        with span(f"db.{helper}", **{"db.helper": helper}):
+            return fn(*args)
+    except Exception:
+        DB_ERRORS.inc(helper)
+        raise
+    finally:
+        DB_SECONDS.observe(time.perf_counter() - started, helper)
+
+
+def db_executor_stats() -> Dict[str, int]:
+    return {"workers": DB_EXECUTOR_WORKERS, "queue_max": DB_EXECUTOR_QUEUE, "pending": _DB_PENDING}
+
+
+@app.on_event("startup")
+async def _startup_db():
+    await run_db(open_pools)
+
+
+@app.on_event("shutdown")
+async def _shutdown_db():
+    global _DB_EXECUTOR
+    await run_db(close_pools)
+    if _DB_EXECUTOR is not None:
+        _DB_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        _DB_EXECUTOR = None
+
 # ================= Dados & Filtros (PostgreSQL) =================
 INFO_TAGS_PF = "tags pontos fortes"
 INFO_TAGS_PD = "tags pontos desenvolvimento"
@@ -440,9 +1241,39 @@ _DAYS_BY_TYPE = { t: DELTA_TEMPO for t in TIPOS_CANON }
 _DAYS_BY_TYPE["resumo avd"] = DELTA_TEMPO_RESUMO
 
 
+# Tabela de infos descoberta no catálogo: resolvida uma vez por processo
+# (ou a cada INFO_TABLE_REFRESH s) e invalidada quando a consulta falha.
+_INFO_TABLE: Optional[Tuple[str, str]] = None
+_INFO_TABLE_AT = 0.0
+_INFO_TABLE_LOCK = threading.Lock()
+
+
 def _discover_info_table(conn) -> Tuple[str, str]:
+    global _INFO_TABLE, _INFO_TABLE_AT
     if DB_SCHEMA and DB_TABLE:
         return DB_SCHEMA, DB_TABLE
+    with _INFO_TABLE_LOCK:
+        cached = _INFO_TABLE
+        if cached and (INFO_TABLE_REFRESH <= 0 or time.monotonic() - _INFO_TABLE_AT < INFO_TABLE_REFRESH):
+            return cached
+    found = _lookup_info_table(conn)
+    with _INFO_TABLE_LOCK:
+        _INFO_TABLE, _INFO_TABLE_AT = found, time.monotonic()
+    return found
+
+
+def invalidate_info_table_cache():
+    global _INFO_TABLE
+    with _INFO_TABLE_LOCK:
+        _INFO_TABLE = None
+
+
+def _missing_relation(e: BaseException) -> bool:
+    # só tabela/coluna inexistente justifica redescobrir a tabela; timeout e conexão caída, não
+    return isinstance(e, (psycopg2.errors.UndefinedTable, psycopg2.errors.UndefinedColumn))
+
+
+def _lookup_info_table(conn) -> Tuple[str, str]:
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -474,120 +1305,136 @@ def _discover_info_table(conn) -> Tuple[str, str]:
         return row["table_schema"], row["table_name"]
 
 
+_BASIC_PROFILE_SQL = """
+    SELECT resumo_pessoa, id, posicao
+    FROM pessoas_ativos
+    WHERE email = %s
+    LIMIT 1
+"""
+
+
+def _profile_from_row(row) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    if not row:
+        return None, None, None
+    resumo_pessoa, id_pessoa, cargo_pessoa = row
+    return (
+        (resumo_pessoa or None),
+        (cargo_pessoa or None),
+        (str(id_pessoa) if id_pessoa is not None else None),
+    )
+
+
+def _query_basic_profile(email: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    # versões _query_*: levantam exceção em erro de banco (usadas pelo cache, que não guarda falhas)
+    with get_pool(DATABASE_URL).connection() as conn, conn.cursor() as cur:
+        cur.execute(_BASIC_PROFILE_SQL, (email,))
+        return _profile_from_row(cur.fetchone())
+
+
 def get_basic_profile(email: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     if not DATABASE_URL:
         return None, None, None
     try:
-        with psycopg2.connect(DATABASE_URL) as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT resumo_pessoa, id, posicao
-                FROM pessoas_ativos
-                WHERE email = %s
-                LIMIT 1;
-                """,
-                (email,)
-            )
-            row = cur.fetchone()
-            if row:
-                resumo_pessoa, id_pessoa, cargo_pessoa = row
-                return (
-                    (resumo_pessoa or None),
-                    (cargo_pessoa or None),
-                    (str(id_pessoa) if id_pessoa is not None else None),
-                )
+        return _query_basic_profile(email)
     except Exception:
-        pass
-    return None, None, None
+        return None, None, None
+
+
+_HISTORICO_BOT_SQL = """
+    SELECT data, output_pessoa_bot
+    FROM outputs_bot_pessoas
+    WHERE email = %s AND data >= %s
+    ORDER BY data DESC
+    LIMIT 5
+"""
+
+
+def _query_historico_bot(email: str, days: int = DELTA_TEMPO_RESUMO) -> str:
+    limit_date = datetime.now(timezone.utc) - timedelta(days=days)
+    with get_pool(DATABASE_URL).connection() as conn, conn.cursor() as cur:
+        cur.execute(_HISTORICO_BOT_SQL, (email, limit_date))
+        rows = cur.fetchall() or []
+    return _format_historico(rows)
+
+
+def _format_historico(rows) -> str:
+    if not rows:
+        return "Não há nenhuma interação até o momento"
+    parts = []
+    for d, resumo in rows:
+        try:
+            ts = d.strftime('%Y-%m-%d') if hasattr(d, 'strftime') else str(d)
+        except Exception:
+            ts = str(d)
+        parts.append(f"data: {ts} - resumo: {str(resumo or '').strip()}")
+    return "; ".join(parts)
 
 
 def get_historico_bot(email: str, days: int = DELTA_TEMPO_RESUMO) -> str:
     if not DATABASE_URL:
         return ""
     try:
-        limit_date = datetime.now(timezone.utc) - timedelta(days=days)
-        with psycopg2.connect(DATABASE_URL) as conn, conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT data, output_pessoa_bot
-                FROM outputs_bot_pessoas
-                WHERE email = %s AND data >= %s
-                ORDER BY data DESC
-                LIMIT 5;
-                """,
-                (email, limit_date)
-            )
-            rows = cur.fetchall() or []
-            if not rows:
-                return "Não há nenhuma interação até o momento"
-            parts = []
-            for d, resumo in rows:
-                try:
-                    ts = d.strftime('%Y-%m-%d') if hasattr(d, 'strftime') else str(d)
-                except Exception:
-                    ts = str(d)
-                parts.append(f"data: {ts} - resumo: {str(resumo or '').strip()}")
-            return "; ".join(parts)
+        return _query_historico_bot(email, days)
     except Exception:
         return ""
 
 
+_RESUMOS_SEMANAL_SQL = """
+    SELECT summary, "timestamp"
+    FROM resumos
+    WHERE employee_email = %s AND "timestamp" >= %s
+    ORDER BY "timestamp" ASC
+"""
+
+
+def _query_resumos_semanal(email: str, days: int = DELTA_TEMPO) -> str:
+    limit_date = datetime.now(timezone.utc) - timedelta(days=days)
+    with get_pool(DATABASE_URL_RESUMO_SEMANAL).connection() as conn, conn.cursor() as cur:
+        cur.execute(_RESUMOS_SEMANAL_SQL, (email, limit_date))
+        rows = cur.fetchall() or []
+    lines = []
+    for summary, ts in rows:
+        try:
+            ts_fmt = ts.strftime('%d/%m/%Y') if hasattr(ts, 'strftime') else str(ts)
+        except Exception:
+            ts_fmt = str(ts)
+        s = str(summary or '').strip()
+        if s:
+            lines.append(f"resumo da semana {ts_fmt} - {s}")
+    return "\n".join(lines)
+
+
 def get_resumos_semanal(email: str, days: int = DELTA_TEMPO) -> str:
     if not DATABASE_URL_RESUMO_SEMANAL:
         return ""
     try:
-        limit_date = datetime.now(timezone.utc) - timedelta(days=days)
-        with psycopg2.connect(DATABASE_URL_RESUMO_SEMANAL) as conn, conn.cursor() as cur:
-            cur.execute(
-                'SELECT summary, "timestamp" FROM resumos WHERE employee_email = %s AND "timestamp" >= %s ORDER BY "timestamp" ASC;',
-                (email, limit_date)
-            )
-            rows = cur.fetchall() or []
-            if not rows:
-                return ""
-            lines = []
-            for summary, ts in rows:
-                try:
-                    ts_fmt = ts.strftime('%d/%m/%Y') if hasattr(ts, 'strftime') else str(ts)
-                except Exception:
-                    ts_fmt = str(ts)
-                s = str(summary or '').strip()
-                if s:
-                    lines.append(f"resumo da semana {ts_fmt} - {s}")
-            return "\n".join(lines)
+        return _query_resumos_semanal(email, days)
     except Exception:
         return ""
 
 
-def get_latest_infos(email: str):
+# DISTINCT ON: última descrição de cada tipo de informação (normalizado) do usuário
+_LATEST_INFOS_SQL = """
+    SELECT DISTINCT ON (info_norm) info_norm, descricao, data
+    FROM (
+        SELECT trim(lower(informacao)) AS info_norm,
+               descricao, data
+        FROM {tbl}
+        WHERE email = %s
+          AND (data IS NULL OR data >= now() - make_interval(days => %s))
+    ) t
+    ORDER BY info_norm, data DESC NULLS LAST
+"""
+
+
+def _info_tbl(conn) -> psql.Composable:
+    schema, table = _discover_info_table(conn)
+    return psql.SQL("{}.{}").format(psql.Identifier(schema), psql.Identifier(table))
+
+
+def _latest_infos_from_rows(rows) -> Tuple[Dict[str, str], Dict[str, Any]]:
     valores = {t: "" for t in TIPOS_CANON}
     datas = {t: None for t in TIPOS_CANON}
-    if not DATABASE_URL:
-        return valores, datas, False, "DATABASE_URL não configurado"
-    from_date_days = max(DELTA_TEMPO_RESUMO, DELTA_TEMPO, TEMPO_ATUALIZACAO)
-    try:
-        with psycopg2.connect(DATABASE_URL) as conn:
-            schema, table = _discover_info_table(conn)
-            tbl = psql.SQL("{}.{}").format(psql.Identifier(schema), psql.Identifier(table))
-            query = psql.SQL(
-                """
-                SELECT DISTINCT ON (info_norm) info_norm, descricao, data
-                FROM (
-                    SELECT trim(lower(informacao)) AS info_norm,
-                           descricao, data
-                    FROM {tbl}
-                    WHERE email = %s
-                      AND (data IS NULL OR data >= now() - make_interval(days => %s))
-                ) t
-                ORDER BY info_norm, data DESC NULLS LAST;
-                """
-            ).format(tbl=tbl)
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute(query, (email, from_date_days))
-                rows = cur.fetchall()
-    except Exception as e:
-        return valores, datas, False, f"Erro ao consultar PostgreSQL: {e}"
-
     now = datetime.now(timezone.utc)
     def _norm(s: str) -> str:
         s = s.lower()
@@ -616,13 +1463,150 @@ def get_latest_infos(email: str):
         if keep and desc:
             valores[canon] = desc
             datas[canon] = d
+    return valores, datas
+
+
+def get_latest_infos(email: str):
+    valores = {t: "" for t in TIPOS_CANON}
+    datas = {t: None for t in TIPOS_CANON}
+    if not DATABASE_URL:
+        return valores, datas, False, "DATABASE_URL não configurado"
+    from_date_days = max(DELTA_TEMPO_RESUMO, DELTA_TEMPO, TEMPO_ATUALIZACAO)
+    try:
+        with get_pool(DATABASE_URL).connection() as conn:
+            query = psql.SQL(_LATEST_INFOS_SQL).format(tbl=_info_tbl(conn))
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(query, (email, from_date_days))
+                rows = cur.fetchall()
+    except Exception as e:
+        if _missing_relation(e):
+            # tabela pode ter sido renomeada/movida: redescobre na próxima chamada
+            invalidate_info_table_cache()
+        return valores, datas, False, f"Erro ao consultar PostgreSQL: {e}"
+    valores, datas = _latest_infos_from_rows(rows)
     return valores, datas, True, "ok"
 
 
-def format_profile_context(email: str, user_name: str, valores: Dict[str, str]) -> str:
-    resumo_pessoa, cargo_pessoa, id_pessoa = get_basic_profile(email)
-    historico = get_historico_bot(email)
-    resumos_sem = get_resumos_semanal(email)
+# Variante para vários emails (lote, times): uma consulta com = ANY e row_number() no lugar de
+# DISTINCT ON por email, lida por cursor nomeado (server-side) em blocos de DB_BULK_ITERSIZE
+_LATEST_INFOS_BULK_SQL = """
+    SELECT email, info_norm, descricao, data
+    FROM (
+        SELECT email, trim(lower(informacao)) AS info_norm, descricao, data,
+               row_number() OVER (PARTITION BY email, trim(lower(informacao)) ORDER BY data DESC NULLS LAST) AS rn
+        FROM {tbl}
+        WHERE email = ANY(%s)
+          AND (data IS NULL OR data >= now() - make_interval(days => %s))
+    ) t
+    WHERE rn = 1
+    ORDER BY email
+"""
+
+
+def _iter_latest_infos_bulk(emails: List[str]) -> Iterator[Tuple[str, Dict[str, str], Dict[str, Any]]]:
+    # gera (email, valores, datas) assim que as linhas de cada email terminam: memória constante
+    # para times grandes. Emails sem nenhuma linha não aparecem. Levanta exceção em erro de banco.
+    from_date_days = max(DELTA_TEMPO_RESUMO, DELTA_TEMPO, TEMPO_ATUALIZACAO)
+    with get_pool(DATABASE_URL).connection() as conn:
+        query = psql.SQL(_LATEST_INFOS_BULK_SQL).format(tbl=_info_tbl(conn))
+        with conn.cursor(name=f"latest_infos_{secrets.token_hex(4)}", cursor_factory=RealDictCursor) as cur:
+            cur.itersize = DB_BULK_ITERSIZE
+            cur.execute(query, (list(emails), from_date_days))
+            current, rows = None, []
+            for row in cur:
+                if row["email"] != current:
+                    if rows:
+                        yield (current, *_latest_infos_from_rows(rows))
+                    current, rows = row["email"], []
+                rows.append(row)
+            if rows:
+                yield (current, *_latest_infos_from_rows(rows))
+
+
+def get_latest_infos_bulk(emails: List[str]) -> Dict[str, Tuple[Dict[str, str], Dict[str, Any], bool, str]]:
+    """`get_latest_infos` para vários emails numa única consulta: {email: (valores, datas, ok, msg)}."""
+    emails = list(dict.fromkeys(e for e in emails if e))
+    result = {e: ({t: "" for t in TIPOS_CANON}, {t: None for t in TIPOS_CANON}, True, "ok") for e in emails}
+    if not DATABASE_URL:
+        return {e: (v, d, False, "DATABASE_URL não configurado") for e, (v, d, _, _) in result.items()}
+    if not emails:
+        return result
+    try:
+        for email, valores, datas in _iter_latest_infos_bulk(emails):
+            result[email] = (valores, datas, True, "ok")
+    except Exception as e:
+        if _missing_relation(e):
+            invalidate_info_table_cache()
+        msg = f"Erro ao consultar PostgreSQL: {e}"
+        return {email: ({t: "" for t in TIPOS_CANON}, {t: None for t in TIPOS_CANON}, False, msg) for email in emails}
+    return result
+
+
+def _parse_ts(v: Any) -> Any:
+    # timestamps chegam como texto ISO quando passam por json_agg/row_to_json
+    if isinstance(v, str):
+        try:
+            return datetime.fromisoformat(v)
+        except ValueError:
+            return v
+    return v
+
+
+def _query_main_bundle(email: str):
+    # perfil + últimas infos + histórico do bot (todos em DATABASE_URL) num único round trip
+    from_date_days = max(DELTA_TEMPO_RESUMO, DELTA_TEMPO, TEMPO_ATUALIZACAO)
+    hist_from = datetime.now(timezone.utc) - timedelta(days=DELTA_TEMPO_RESUMO)
+    with get_pool(DATABASE_URL).connection() as conn:
+        query = psql.SQL(
+            """
+            WITH perfil AS ({perfil}),
+                 infos AS ({infos}),
+                 hist AS ({hist})
+            SELECT (SELECT row_to_json(p) FROM perfil p) AS perfil,
+                   (SELECT coalesce(json_agg(i), '[]'::json) FROM infos i) AS infos,
+                   (SELECT coalesce(json_agg(h ORDER BY h.data DESC), '[]'::json) FROM hist h) AS hist;
+            """
+        ).format(
+            perfil=psql.SQL(_BASIC_PROFILE_SQL),
+            infos=psql.SQL(_LATEST_INFOS_SQL).format(tbl=_info_tbl(conn)),
+            hist=psql.SQL(_HISTORICO_BOT_SQL),
+        )
+        with conn.cursor() as cur:
+            cur.execute(query, (email, email, from_date_days, email, hist_from))
+            perfil_row, info_rows, hist_rows = cur.fetchone()
+    perfil = _profile_from_row(
+        (perfil_row["resumo_pessoa"], perfil_row["id"], perfil_row["posicao"]) if perfil_row else None
+    )
+    valores, datas = _latest_infos_from_rows(
+        [{**r, "data": _parse_ts(r.get("data"))} for r in info_rows]
+    )
+    historico = _format_historico([(_parse_ts(r.get("data")), r.get("output_pessoa_bot")) for r in hist_rows])
+    return (valores, datas, True, "ok"), perfil, historico
+
+
+@dataclass
+class UserContext:
+    """Dados do usuário carregados uma única vez por turno do chat."""
+    email: str
+    valores: Dict[str, str]
+    datas: Dict[str, Any]
+    ok_db: bool
+    msg_db: str
+    resumo_pessoa: Optional[str] = None
+    cargo_pessoa: Optional[str] = None
+    id_pessoa: Optional[str] = None
+    historico_bot: str = ""
+    resumos_semanal: str = ""
+
+
+def format_profile_context(email: str, user_name: str, valores: Dict[str, str], uctx: Optional[UserContext] = None) -> str:
+    if uctx is not None:
+        resumo_pessoa, cargo_pessoa, id_pessoa = uctx.resumo_pessoa, uctx.cargo_pessoa, uctx.id_pessoa
+        historico, resumos_sem = uctx.historico_bot, uctx.resumos_semanal
+    else:
+        resumo_pessoa, cargo_pessoa, id_pessoa = get_basic_profile(email)
+        historico = get_historico_bot(email)
+        resumos_sem = get_resumos_semanal(email)
     lines = [f"email: {email}", f"nome: {user_name}"]
     if id_pessoa: lines.append(f"id_pessoa: {id_pessoa}")
     if cargo_pessoa: lines.append(f"cargo: {cargo_pessoa}")
@@ -632,19 +1616,914 @@ def format_profile_context(email: str, user_name: str, valores: Dict[str, str])
         if v:
             lines.append(f"{k}: {v}")
     if historico:
-        lines.append(f"historico_bot: {historico}")
+        lines.append(f"historico_bot: {clip_to_tokens(historico, PROMPT_HISTORICO_MAX_TOKENS)}")
     if resumos_sem:
         lines.append("resumos_semanais:")
-        lines.append(resumos_sem)
+        lines.append(compact_resumos(resumos_sem, PROMPT_RESUMOS_MAX_TOKENS))
     if len(lines) <= 2:
         lines.append("(sem dados válidos no intervalo configurado)")
     return "\n".join(lines)
 
+
+# ================= Diagnóstico de consultas (EXPLAIN) =================
+# Roda EXPLAIN (ANALYZE, BUFFERS) nas consultas do caminho do chat para um email de amostra
+# e confere no catálogo os índices que elas precisam (email + coluna de tempo; nas infos,
+# também a expressão trim(lower(informacao)) do DISTINCT ON). Só SELECTs: nada é alterado,
+# a não ser com create=True, que cria os índices que faltam (CONCURRENTLY, sem travar escrita).
+def _table_schema(conn, table: str) -> str:
+    # schema onde o nome sem qualificação resolve (search_path, igual às consultas do bot);
+    # tabela inexistente cai no current_schema()
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COALESCE(
+                (SELECT n.nspname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                 WHERE c.oid = to_regclass(%s)),
+                current_schema())
+            """,
+            (table,),
+        )
+        return cur.fetchone()[0]
+
+
+def _index_advice() -> List[Dict[str, Any]]:
+    # (dsn, schema, tabela, colunas como o pg_get_indexdef mostra, nome, colunas do DDL)
+    advice = []
+    if DATABASE_URL:
+        with get_pool(DATABASE_URL).connection() as conn:
+            schema, table = _discover_info_table(conn)
+            pessoas_schema = _table_schema(conn, "pessoas_ativos")
+            outputs_schema = _table_schema(conn, "outputs_bot_pessoas")
+        advice += [
+            (DATABASE_URL, pessoas_schema, "pessoas_ativos", ["email"], "pessoas_ativos_email_idx", "(email)"),
+            (DATABASE_URL, schema, table, ["email", "btrim(lower(informacao))", "data"],
+             f"{table.lower()}_email_info_data_idx", "(email, (trim(lower(informacao))), data DESC NULLS LAST)"),
+            (DATABASE_URL, outputs_schema, "outputs_bot_pessoas", ["email", "data"],
+             "outputs_bot_pessoas_email_data_idx", "(email, data DESC)"),
+        ]
+    if DATABASE_URL_RESUMO_SEMANAL:
+        with get_pool(DATABASE_URL_RESUMO_SEMANAL).connection() as conn:
+            resumos_schema = _table_schema(conn, "resumos")
+        advice.append((DATABASE_URL_RESUMO_SEMANAL, resumos_schema, "resumos", ["employee_email", "timestamp"],
+                       "resumos_employee_email_timestamp_idx", '(employee_email, "timestamp")'))
+    return [dict(zip(("dsn", "schema", "table", "columns", "name", "ddl_columns"), a)) for a in advice]
+
+
+def _existing_index_columns(cur, schema: str, table: str) -> List[List[str]]:
+    cur.execute(
+        """
+        SELECT array_agg(pg_get_indexdef(i.indexrelid, k, true) ORDER BY k)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        CROSS JOIN LATERAL generate_series(1, i.indnkeyatts) AS k
+        WHERE n.nspname = %s AND c.relname = %s
+        GROUP BY i.indexrelid
+        """,
+        (schema, table),
+    )
+    # PostgreSQL 14+ mostra trim() como TRIM(BOTH FROM ...); versões anteriores, como btrim(...)
+    norm = lambda col: re.sub(r'[\s"]', "", col.lower()).replace("trim(bothfrom", "btrim(")
+    return [[norm(c) for c in cols] for (cols,) in cur.fetchall()]
+
+
+def _plan_nodes(node: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield node
+    for child in node.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def _explain(dsn: str, sql: Any, params: tuple) -> Dict[str, Any]:
+    with get_pool(dsn).connection() as conn, conn.cursor() as cur:
+        cur.execute(psql.SQL("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {}").format(
+            sql if isinstance(sql, psql.Composable) else psql.SQL(sql)), params)
+        result = cur.fetchone()[0]
+        conn.rollback()
+    result = result[0] if isinstance(result, list) else json.loads(result)[0]
+    plan = result["Plan"]
+    scans = [
+        {"node": n["Node Type"], "relation": n.get("Relation Name"), "index": n.get("Index Name"),
+         "rows": n.get("Actual Rows"), "removed_by_filter": n.get("Rows Removed by Filter", 0)}
+        for n in _plan_nodes(plan) if "Scan" in n["Node Type"] and n.get("Relation Name")
+    ]
+    return {
+        "ms": round(result.get("Execution Time", 0.0), 3),
+        "planning_ms": round(result.get("Planning Time", 0.0), 3),
+        "shared_hit_blocks": plan.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": plan.get("Shared Read Blocks", 0),
+        "seq_scans": [s["relation"] for s in scans if s["node"] == "Seq Scan"],
+        "scans": scans,
+        "plan": plan,
+    }
+
+
+def db_diagnostics(email: Optional[str] = None, create: bool = False, with_plans: bool = False) -> Dict[str, Any]:
+    """EXPLAIN das consultas do bot para `email` (padrão: 1º de pessoas_ativos) + índices recomendados."""
+    if not DATABASE_URL:
+        return {"ok": False, "msg": "DATABASE_URL não configurado"}
+    if not email:
+        with get_pool(DATABASE_URL).connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT email FROM pessoas_ativos WHERE email IS NOT NULL LIMIT 1")
+            row = cur.fetchone()
+            email = row[0] if row else ""
+    from_date_days = max(DELTA_TEMPO_RESUMO, DELTA_TEMPO, TEMPO_ATUALIZACAO)
+    now = datetime.now(timezone.utc)
+    with get_pool(DATABASE_URL).connection() as conn:
+        info_tbl = _info_tbl(conn)
+    queries = [
+        ("basic_profile", DATABASE_URL, _BASIC_PROFILE_SQL, (email,)),
+        ("latest_infos", DATABASE_URL, psql.SQL(_LATEST_INFOS_SQL).format(tbl=info_tbl), (email, from_date_days)),
+        ("latest_infos_bulk", DATABASE_URL, psql.SQL(_LATEST_INFOS_BULK_SQL).format(tbl=info_tbl), ([email], from_date_days)),
+        ("historico_bot", DATABASE_URL, _HISTORICO_BOT_SQL, (email, now - timedelta(days=DELTA_TEMPO_RESUMO))),
+    ]
+    if DATABASE_URL_RESUMO_SEMANAL:
+        queries.append(("resumos_semanal", DATABASE_URL_RESUMO_SEMANAL, _RESUMOS_SEMANAL_SQL, (email, now - timedelta(days=DELTA_TEMPO))))
+    report: Dict[str, Any] = {"ok": True, "email": email, "queries": {}, "indexes": []}
+    for name, dsn, sql, params in queries:
+        try:
+            explained = _explain(dsn, sql, params)
+            if not with_plans:
+                explained.pop("plan")
+            report["queries"][name] = explained
+        except Exception as e:
+            report["ok"] = False
+            report["queries"][name] = {"error": repr(e)}
+
+    for adv in _index_advice():
+        qualified = f'"{adv["schema"]}"."{adv["table"]}"'
+        ddl = f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{adv["name"]}" ON {qualified} {adv["ddl_columns"]}'
+        item = {"table": f'{adv["schema"]}.{adv["table"]}', "columns": adv["columns"], "ddl": ddl}
+        try:
+            with get_pool(adv["dsn"]).connection() as conn, conn.cursor() as cur:
+                existing = _existing_index_columns(cur, adv["schema"], adv["table"])
+            # coberto se algum índice começa pelas mesmas colunas (a ordem ASC/DESC não importa aqui)
+            item["exists"] = any(cols[:len(adv["columns"])] == adv["columns"] for cols in existing)
+            if create and not item["exists"]:
+                # conexão própria: CONCURRENTLY não roda em transação e não deve cair no statement_timeout
+                conn = psycopg2.connect(adv["dsn"], connect_timeout=DB_CONNECT_TIMEOUT)
+                try:
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(ddl)
+                    item["created"] = True
+                finally:
+                    conn.close()
+        except Exception as e:
+            report["ok"] = False
+            item["error"] = repr(e)
+        report["indexes"].append(item)
+    report["missing_indexes"] = [i["ddl"] for i in report["indexes"] if not i.get("exists") and not i.get("created")]
+    return report
+
+
+# ================= Cache de perfil (read-through) =================
+class TTLCache:
+    """LRU em memória com TTL por entrada.
+
+    Depois do TTL a entrada ainda fica `stale` por uma janela extra: quem lê recebe o valor
+    antigo na hora e a atualização roda em background (stale-while-revalidate).
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[Any, Tuple[float, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.stale_hits = self.misses = self.evicted = 0
+
+    def get(self, key: Any) -> Tuple[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                fresh_until, stale_until, value = item
+                if now < fresh_until:
+                    self.hits += 1
+                    self._data.move_to_end(key)
+                    return "fresh", value
+                if now < stale_until:
+                    self.stale_hits += 1
+                    return "stale", value
+                del self._data[key]
+            self.misses += 1
+            return "miss", None
+
+    def set(self, key: Any, value: Any, ttl: float, stale: float = 0) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + ttl, now + ttl + max(0, stale), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    def invalidate(self, match: Callable[[Any], bool]) -> int:
+        with self._lock:
+            keys = [k for k in self._data if match(k)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            size = len(self._data)
+        return {"size": size, "max_entries": self.max_entries, "hits": self.hits,
+                "stale_hits": self.stale_hits, "misses": self.misses, "evicted": self.evicted}
+
+
+# chave: (fonte, email)
+PROFILE_CACHE = TTLCache(CACHE_MAX_ENTRIES)
+_CACHE_TTLS = {
+    "perfil": CACHE_TTL_PERFIL,
+    "infos": CACHE_TTL_INFOS,
+    "historico": CACHE_TTL_HISTORICO,
+    "resumos": CACHE_TTL_RESUMOS,
+}
+_REVALIDATING: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+async def _fetch_into_cache(key: Tuple[str, str], fetch: Callable[[], Awaitable[Tuple[Any, bool]]]) -> Any:
+    value, ok = await fetch()
+    if ok:  # falhas de banco não são cacheadas
+        PROFILE_CACHE.set(key, value, _CACHE_TTLS[key[0]], CACHE_STALE)
+    return value
+
+
+async def _revalidate(key: Tuple[str, str], fetch: Callable[[], Awaitable[Tuple[Any, bool]]]):
+    try:
+        await _fetch_into_cache(key, fetch)
+    except Exception as e:
+        print(f"[Cache] Falha ao atualizar {key[0]}: {e}")
+    finally:
+        _REVALIDATING.pop(key, None)
+
+
+async def _read_through(source: str, email: str, fetch: Callable[[], Awaitable[Tuple[Any, bool]]]) -> Any:
+    if _CACHE_TTLS[source] <= 0:
+        return (await fetch())[0]
+    key = (source, email)
+    state, value = PROFILE_CACHE.get(key)
+    if state == "fresh":
+        return value
+    if state == "stale":
+        if key not in _REVALIDATING:
+            _REVALIDATING[key] = asyncio.create_task(_revalidate(key, fetch))
+        return value
+    return await _fetch_into_cache(key, fetch)
+
+
+async def _fetch_many_into_cache(keys: List[Tuple[str, str]], fetch: Callable[[], Awaitable[List[Tuple[Any, bool]]]]) -> List[Any]:
+    results = await fetch()
+    for key, (value, ok) in zip(keys, results):
+        if ok and _CACHE_TTLS[key[0]] > 0:
+            PROFILE_CACHE.set(key, value, _CACHE_TTLS[key[0]], CACHE_STALE)
+    return [value for value, _ in results]
+
+
+async def _revalidate_many(keys: List[Tuple[str, str]], fetch: Callable[[], Awaitable[List[Tuple[Any, bool]]]]):
+    try:
+        await _fetch_many_into_cache(keys, fetch)
+    except Exception as e:
+        print(f"[Cache] Falha ao atualizar {[k[0] for k in keys]}: {e}")
+    finally:
+        for key in keys:
+            _REVALIDATING.pop(key, None)
+
+
+async def _read_through_many(keys: List[Tuple[str, str]], fetch: Callable[[], Awaitable[List[Tuple[Any, bool]]]]) -> List[Any]:
+    # variante de _read_through para fontes buscadas juntas (uma consulta preenche várias chaves)
+    looked = [PROFILE_CACHE.get(k) if _CACHE_TTLS[k[0]] > 0 else ("miss", None) for k in keys]
+    if all(state != "miss" for state, _ in looked):
+        if any(state == "stale" for state, _ in looked) and not any(k in _REVALIDATING for k in keys):
+            task = asyncio.create_task(_revalidate_many(keys, fetch))
+            for key in keys:
+                _REVALIDATING[key] = task
+        return [value for _, value in looked]
+    return await _fetch_many_into_cache(keys, fetch)
+
+
+def invalidate_user_cache(email: str) -> int:
+    removed = SNAPSHOTS.delete(email) if SNAPSHOTS is not None else 0
+    return removed + PROFILE_CACHE.invalidate(lambda k: k[1] == email)
+
+
+async def _fetch(query: Callable[[str], Any], default: Any, email: str) -> Tuple[Any, bool]:
+    try:
+        return await run_db(query, email), True
+    except DBBusy:
+        raise
+    except Exception:
+        return default, False
+
+
+async def _fetch_infos(email: str) -> Tuple[Any, bool]:
+    try:
+        result = await run_db(get_latest_infos, email)
+    except DBBusy:
+        raise
+    except Exception as e:
+        result = ({t: "" for t in TIPOS_CANON}, {t: None for t in TIPOS_CANON}, False, f"Erro ao consultar PostgreSQL: {e!r}")
+    return result, result[2]
+
+
+# Versões assíncronas (rotas): cache + consultas fora do event loop
+async def aget_basic_profile(email: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    if not DATABASE_URL:
+        return None, None, None
+    return await _read_through("perfil", email, lambda: _fetch(_query_basic_profile, (None, None, None), email))
+
+
+async def aget_historico_bot(email: str) -> str:
+    if not DATABASE_URL:
+        return ""
+    return await _read_through("historico", email, lambda: _fetch(_query_historico_bot, "", email))
+
+
+async def aget_resumos_semanal(email: str) -> str:
+    if not DATABASE_URL_RESUMO_SEMANAL:
+        return ""
+    return await _read_through("resumos", email, lambda: _fetch(_query_resumos_semanal, "", email))
+
+
+async def aget_latest_infos(email: str):
+    return await _read_through("infos", email, lambda: _fetch_infos(email))
+
+
+_BUNDLE_FALLBACK_LOGGED = False
+
+
+def _log_bundle_fallback(e: BaseException):
+    global _BUNDLE_FALLBACK_LOGGED
+    if not _BUNDLE_FALLBACK_LOGGED:
+        _BUNDLE_FALLBACK_LOGGED = True
+        print(f"[DB] Consulta combinada falhou, usando consultas separadas: {e!r}")
+
+
+async def _fetch_main_bundle(email: str) -> List[Tuple[Any, bool]]:
+    try:
+        infos, perfil, historico = await run_db(_query_main_bundle, email)
+        return [(infos, True), (perfil, True), (historico, True)]
+    except DBBusy:
+        raise
+    except (psycopg2.ProgrammingError, RuntimeError) as e:
+        # ex.: uma das tabelas não existe neste banco (ou a de infos não foi achada) → consultas separadas
+        _log_bundle_fallback(e)
+        return list(await asyncio.gather(
+            _fetch_infos(email),
+            _fetch(_query_basic_profile, (None, None, None), email),
+            _fetch(_query_historico_bot, "", email),
+        ))
+    except Exception as e:
+        # timeout/pool esgotado: repetir em 3 consultas só aumentaria a carga; o turno segue com o aviso
+        infos = ({t: "" for t in TIPOS_CANON}, {t: None for t in TIPOS_CANON}, False, f"Erro ao consultar PostgreSQL: {e!r}")
+        return [(infos, False), ((None, None, None), False), ("", False)]
+
+
+async def aget_main_bundle(email: str):
+    # infos + perfil + histórico do bot: 1 round trip em DATABASE_URL (ou 3, com DB_COMBINED_QUERY=0)
+    if not (DB_COMBINED_QUERY and DATABASE_URL):
+        return await asyncio.gather(aget_latest_infos(email), aget_basic_profile(email), aget_historico_bot(email))
+    keys = [("infos", email), ("perfil", email), ("historico", email)]
+    return await _read_through_many(keys, lambda: _fetch_main_bundle(email))
+
+
+async def load_user_context(email: str) -> UserContext:
+    # DATABASE_URL e DATABASE_URL_RESUMO_SEMANAL são consultados em paralelo, uma vez por turno
+    with span("load_user_context"):
+        if SNAPSHOTS is not None:
+            # pessoa ativa com snapshot recente: um único registro local, sem ir aos bancos
+            snapshot = await asyncio.to_thread(SNAPSHOTS.get, email)
+            if snapshot is not None:
+                set_span_attr("context.source", "snapshot")
+                return snapshot
+        ((valores, datas, ok_db, msg_db), perfil, historico), resumos = await asyncio.gather(
+            aget_main_bundle(email),
+            aget_resumos_semanal(email),
+        )
+    resumo_pessoa, cargo_pessoa, id_pessoa = perfil
+    return UserContext(
+        email=email, valores=valores, datas=datas, ok_db=ok_db, msg_db=msg_db,
+        resumo_pessoa=resumo_pessoa, cargo_pessoa=cargo_pessoa, id_pessoa=id_pessoa,
+        historico_bot=historico, resumos_semanal=resumos,
+    )
+
+# ================= Snapshots de contexto =================
+# Pacote perfil + últimas infos + histórico + resumos de cada pessoa ativa (pessoas_ativos),
+# pré-calculado fora do caminho do chat: refresh_snapshots.py (cron) ou SNAPSHOT_REFRESH_INTERVAL.
+# Cada pessoa tem uma versão (hash de contagem/última data das linhas de origem): só quem mudou,
+# ou cujo snapshot passou de SNAPSHOT_REBUILD_AGE (as janelas em dias andam sozinhas), é recalculado.
+_SNAPSHOT_VERSIONS_SQL = """
+    WITH i AS (SELECT email, count(*) AS n, max(data) AS m FROM {infos} GROUP BY email),
+         o AS (SELECT email, count(*) AS n, max(data) AS m FROM outputs_bot_pessoas GROUP BY email)
+    SELECT p.email, md5(concat_ws('|', p.resumo_pessoa, p.id, p.posicao, i.n, i.m, o.n, o.m))
+    FROM pessoas_ativos p
+    LEFT JOIN i USING (email)
+    LEFT JOIN o USING (email)
+    WHERE p.email IS NOT NULL
+"""
+
+_SNAPSHOT_RESUMOS_VERSIONS_SQL = """
+    SELECT employee_email, md5(concat_ws('|', count(*), max("timestamp")))
+    FROM resumos
+    GROUP BY employee_email
+"""
+
+
+class SnapshotStore:
+    def __init__(self, path: str, max_age: float):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = self.misses = 0
+
+    @property
+    def _conn(self):
+        # aberto sob demanda; chamar com self._lock
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS context_snapshots ("
+                " email TEXT PRIMARY KEY, version TEXT NOT NULL, data TEXT NOT NULL,"
+                " built_at REAL NOT NULL, checked_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def get(self, email: str) -> Optional[UserContext]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM context_snapshots WHERE email = ? AND checked_at > ?", (email, time.time() - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        data = json.loads(row[0])
+        data["datas"] = {k: _parse_ts(v) for k, v in data["datas"].items()}
+        return UserContext(**data)
+
+    def versions(self) -> Dict[str, Tuple[str, float]]:
+        with self._lock:
+            return {e: (v, b) for e, v, b in self._conn.execute("SELECT email, version, built_at FROM context_snapshots")}
+
+    def put(self, uctx: UserContext, version: str) -> None:
+        data = json.dumps(asdict(uctx), ensure_ascii=False, default=lambda v: v.isoformat() if hasattr(v, "isoformat") else str(v))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO context_snapshots (email, version, data, built_at, checked_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(email) DO UPDATE SET version = excluded.version, data = excluded.data,"
+                " built_at = excluded.built_at, checked_at = excluded.checked_at",
+                (uctx.email, version, data, now, now),
+            )
+
+    def touch(self, emails: List[str]) -> None:
+        # confirmados sem mudança nesta rodada: continuam válidos para o chat
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE context_snapshots SET checked_at = ? WHERE email = ?", [(now, e) for e in emails])
+
+    def delete(self, email: str) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM context_snapshots WHERE email = ?", (email,)).rowcount
+
+    def prune(self, keep: set) -> int:
+        # remove quem saiu de pessoas_ativos
+        with self._lock:
+            gone = [(e,) for (e,) in self._conn.execute("SELECT email FROM context_snapshots") if e not in keep]
+            self._conn.executemany("DELETE FROM context_snapshots WHERE email = ?", gone)
+        return len(gone)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, oldest = self._conn.execute("SELECT COUNT(*), MIN(checked_at) FROM context_snapshots").fetchone()
+        return {"entries": entries, "max_age": self.max_age, "hits": self.hits, "misses": self.misses,
+                "oldest_check_age": round(time.time() - oldest, 1) if oldest else None,
+                "last_refresh": _SNAPSHOT_LAST_REFRESH}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+SNAPSHOTS: Optional[SnapshotStore] = SnapshotStore(SNAPSHOT_PATH, SNAPSHOT_MAX_AGE) if SNAPSHOTS_ENABLED else None
+_SNAPSHOT_LAST_REFRESH: Optional[Dict[str, Any]] = None
+_SNAPSHOT_REFRESHER: Optional[asyncio.Task] = None
+
+
+def _query_snapshot_versions() -> Dict[str, str]:
+    with get_pool(DATABASE_URL).connection() as conn:
+        query = psql.SQL(_SNAPSHOT_VERSIONS_SQL).format(infos=_info_tbl(conn))
+        with conn.cursor() as cur:
+            cur.execute(query)
+            versions = {email: version for email, version in cur.fetchall()}
+    if DATABASE_URL_RESUMO_SEMANAL and versions:
+        with get_pool(DATABASE_URL_RESUMO_SEMANAL).connection() as conn, conn.cursor() as cur:
+            cur.execute(_SNAPSHOT_RESUMOS_VERSIONS_SQL)
+            for email, version in cur.fetchall():
+                if email in versions:
+                    versions[email] += version
+    return versions
+
+
+def _query_user_context(email: str) -> UserContext:
+    # mesmo conteúdo de load_user_context, direto do banco (sem cache) e levantando em erro
+    try:
+        (valores, datas, ok_db, msg_db), perfil, historico = _query_main_bundle(email)
+    except (psycopg2.ProgrammingError, RuntimeError) as e:
+        _log_bundle_fallback(e)
+        valores, datas, ok_db, msg_db = get_latest_infos(email)
+        if not ok_db:
+            raise RuntimeError(msg_db)
+        perfil, historico = _query_basic_profile(email), _query_historico_bot(email)
+    resumos = _query_resumos_semanal(email) if DATABASE_URL_RESUMO_SEMANAL else ""
+    resumo_pessoa, cargo_pessoa, id_pessoa = perfil
+    return UserContext(
+        email=email, valores=valores, datas=datas, ok_db=ok_db, msg_db=msg_db,
+        resumo_pessoa=resumo_pessoa, cargo_pessoa=cargo_pessoa, id_pessoa=id_pessoa,
+        historico_bot=historico, resumos_semanal=resumos,
+    )
+
+
+def refresh_snapshots(store: Optional[SnapshotStore] = None, full: bool = False) -> Dict[str, Any]:
+    """Recalcula os snapshots de quem mudou desde a última rodada (`full=True`: de todos)."""
+    global _SNAPSHOT_LAST_REFRESH
+    store = store or SNAPSHOTS
+    if store is None or not DATABASE_URL:
+        return {"ok": False, "msg": "snapshots desligados ou DATABASE_URL não configurado"}
+    started = time.monotonic()
+    versions = _query_snapshot_versions()
+    stored, now = store.versions(), time.time()
+    changed, unchanged = [], []
+    for email, version in versions.items():
+        old = stored.get(email)
+        if full or old is None or old[0] != version or now - old[1] > SNAPSHOT_REBUILD_AGE:
+            changed.append(email)
+        else:
+            unchanged.append(email)
+    store.touch(unchanged)
+    refreshed = failed = 0
+    for email in changed:
+        try:
+            store.put(_query_user_context(email), versions[email])
+            refreshed += 1
+        except Exception as e:
+            failed += 1
+            store.delete(email)  # melhor cair no caminho ao vivo do que servir dado velho
+            print(f"[Snapshots] Falha ao recalcular {email}: {e!r}")
+    result = {
+        "ok": True, "active": len(versions), "refreshed": refreshed, "unchanged": len(unchanged),
+        "failed": failed, "removed": store.prune(set(versions)),
+        "seconds": round(time.monotonic() - started, 2), "at": datetime.now(timezone.utc).isoformat(),
+    }
+    _SNAPSHOT_LAST_REFRESH = result
+    print(f"[Snapshots] {result}")
+    return result
+
+
+async def _refresh_snapshots_forever():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_snapshots)
+        except Exception as e:
+            print(f"[Snapshots] Falha na atualização: {e!r}")
+        await asyncio.sleep(SNAPSHOT_REFRESH_INTERVAL)
+
+
+@app.on_event("startup")
+async def _startup_snapshots():
+    global _SNAPSHOT_REFRESHER
+    if SNAPSHOTS is not None and SNAPSHOT_REFRESH_INTERVAL > 0:
+        _SNAPSHOT_REFRESHER = asyncio.create_task(_refresh_snapshots_forever())
+
+
+@app.on_event("shutdown")
+async def _shutdown_snapshots():
+    global _SNAPSHOT_REFRESHER
+    if _SNAPSHOT_REFRESHER is not None:
+        _SNAPSHOT_REFRESHER.cancel()
+        _SNAPSHOT_REFRESHER = None
+    if SNAPSHOTS is not None:
+        SNAPSHOTS.close()
+
+
 # ================= Flowise =================
+_FLOWISE_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def flowise_url() -> Optional[str]:
+    if FLOWISE_PREDICTION_URL:
+        return FLOWISE_PREDICTION_URL
+    if FLOWISE_URL and FLOWISE_CHATFLOW_ID:
+        return f"{FLOWISE_URL.rstrip('/')}/api/v1/prediction/{FLOWISE_CHATFLOW_ID}"
+    return None
+
+
+def _build_flowise_client() -> httpx.AsyncClient:
+    http2 = FLOWISE_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401  (extra opcional do httpx)
+        except ImportError:
+            print("[Flowise] FLOWISE_HTTP2 ligado, mas o pacote h2 não está instalado; usando HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=FLOWISE_MAX_CONNECTIONS,
+        max_keepalive_connections=FLOWISE_MAX_KEEPALIVE,
+        keepalive_expiry=FLOWISE_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(limits=limits, http2=http2, timeout=httpx.Timeout(60.0, pool=FLOWISE_POOL_TIMEOUT))
+
+
+def get_flowise_client() -> httpx.AsyncClient:
+    global _FLOWISE_CLIENT
+    if _FLOWISE_CLIENT is None or _FLOWISE_CLIENT.is_closed:
+        _FLOWISE_CLIENT = _build_flowise_client()
+    return _FLOWISE_CLIENT
+
+
+def _flowise_timeout(seconds: float) -> httpx.Timeout:
+    return httpx.Timeout(seconds, pool=FLOWISE_POOL_TIMEOUT)
+
+
+@app.on_event("startup")
+async def _startup_flowise():
+    get_flowise_client()
+
+
+@app.on_event("shutdown")
+async def _shutdown_flowise():
+    global _FLOWISE_CLIENT
+    if _FLOWISE_CLIENT is not None:
+        await _FLOWISE_CLIENT.aclose()
+        _FLOWISE_CLIENT = None
+
+
+# Política de retentativa + circuit breaker. Só 429/5xx e falhas de conexão são retentadas,
+# com backoff exponencial e jitter (respeitando Retry-After). Depois de N falhas seguidas
+# o breaker abre e todas as chamadas falham na hora até o cooldown; então uma sonda testa.
+# O breaker conta uma falha por chamada, depois de esgotadas as tentativas.
+FLOWISE_OPEN_MSG = "(Flowise indisponível) Serviço instável no momento; tente novamente em alguns minutos."
+# só erros antes do envio: conexão caída no meio (RemoteProtocolError) pode ser depois de o Flowise
+# já ter recebido o pedido, e a geração não é idempotente
+_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at: Optional[float] = None
+        self.opened = self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.threshold <= 0 or self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.probe_at = None
+        # half_open: uma sonda por vez (sonda sem resposta há mais de um cooldown é substituída)
+        if self.probe_at is not None and now - self.probe_at < self.cooldown:
+            self.rejected += 1
+            return False
+        self.probe_at = now
+        return True
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probe_at = None
+
+    def failure(self):
+        self.failures += 1
+        self.probe_at = None
+        if self.threshold > 0 and (self.state == "half_open" or self.failures >= self.threshold):
+            if self.state != "open":
+                self.opened += 1
+                print(f"[Flowise] Circuit breaker aberto após {self.failures} falhas seguidas")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at)) if self.state == "open" else 0.0
+        return {"state": self.state, "consecutive_failures": self.failures, "threshold": self.threshold,
+                "cooldown": self.cooldown, "retry_in": round(retry_in, 1), "opened": self.opened,
+                "rejected": self.rejected}
+
+
+FLOWISE_BREAKER = CircuitBreaker(FLOWISE_BREAKER_FAILURES, FLOWISE_BREAKER_COOLDOWN)
+
+
+def _is_retryable_status(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+def _retry_delay(attempt: int, resp: Optional[httpx.Response] = None) -> Optional[float]:
+    # None = não vale esperar (Retry-After maior que o teto configurado)
+    retry_after = resp.headers.get("retry-after") if resp is not None else None
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except Exception:
+                wait = None
+        if wait is not None:
+            return max(0.0, wait) if wait <= FLOWISE_RETRY_MAX_DELAY else None
+    return random.uniform(0, min(FLOWISE_RETRY_MAX_DELAY, FLOWISE_RETRY_BASE * (2 ** attempt)))
+
+
+async def _post_flowise(url: str, headers: Dict[str, str], payload: Dict[str, Any],
+                        timeout: float, mode: str = "blocking") -> Tuple[Optional[httpx.Response], str]:
+    # Devolve (resposta, "") ou (None, mensagem de erro pronta para o usuário).
+    client = get_flowise_client()
+    if not FLOWISE_BREAKER.allow():
+        FLOWISE_RESPONSES.inc(mode, "breaker_open")
+        return None, FLOWISE_OPEN_MSG
+    for attempt in range(FLOWISE_RETRIES + 1):
+        if attempt and FLOWISE_BREAKER.state == "open":
+            # outras chamadas abriram o circuito durante a espera: não insiste
+            FLOWISE_RESPONSES.inc(mode, "breaker_open")
+            return None, FLOWISE_OPEN_MSG
+        last = attempt == FLOWISE_RETRIES
+        started = time.perf_counter()
+        try:
+            with span("flowise.attempt", **{"flowise.mode": mode, "flowise.attempt": attempt + 1,
+                                            "prompt.chars": len(str(payload.get("question", "")))}) as sp:
+                resp = await client.post(url, headers=headers, json=payload, timeout=_flowise_timeout(timeout))
+                if sp is not None:
+                    sp.set("http.status_code", resp.status_code)
+                    sp.set("response.bytes", len(resp.content))
+        except httpx.PoolTimeout as e:
+            # fila local de conexões cheia: não é falha do Flowise
+            FLOWISE_RESPONSES.inc(mode, "pool_timeout")
+            return None, f"(Flowise indisponível) Erro: {e!r}"
+        except _RETRYABLE_ERRORS as e:
+            FLOWISE_SECONDS.observe(time.perf_counter() - started, mode)
+            FLOWISE_RESPONSES.inc(mode, "connect_error")
+            if last:
+                FLOWISE_BREAKER.failure()
+                return None, f"(Flowise indisponível) Erro: {e}"
+            FLOWISE_RETRIES_TOTAL.inc("connect_error")
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        except Exception as e:
+            FLOWISE_SECONDS.observe(time.perf_counter() - started, mode)
+            FLOWISE_RESPONSES.inc(mode, "timeout" if isinstance(e, httpx.TimeoutException) else "error")
+            if isinstance(e, httpx.TransportError):
+                FLOWISE_BREAKER.failure()
+            return None, f"(Flowise indisponível) Erro: {e!r}"
+        FLOWISE_SECONDS.observe(time.perf_counter() - started, mode)
+        FLOWISE_RESPONSES.inc(mode, resp.status_code)
+        if not _is_retryable_status(resp.status_code):
+            FLOWISE_BREAKER.success()
+            return resp, ""
+        delay = None if last else _retry_delay(attempt, resp)
+        if delay is None:
+            FLOWISE_BREAKER.failure()
+            return resp, ""
+        FLOWISE_RETRIES_TOTAL.inc(resp.status_code)
+        print(f"[Flowise] HTTP {resp.status_code}; nova tentativa em {delay:.1f}s")
+        await asyncio.sleep(delay)
+    return None, "(Flowise indisponível)"
+
+
+# Controle de admissão das gerações: teto global de chamadas simultâneas ao Flowise,
+# no máx. FLOWISE_PER_USER por usuário e fila limitada (com timeout) atendida em
+# round-robin entre usuários, para uma rajada de um só não atrasar os demais.
+FLOWISE_BUSY_MSG = "(Flowise indisponível) Muitas gerações em andamento; tente novamente em instantes."
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionController:
+    def __init__(self, limit: int, per_user: int, max_waiting: int, wait_timeout: float):
+        self.limit = limit
+        self.per_user = per_user
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self.active_by_user: Dict[str, int] = {}
+        self._waiting: "OrderedDict[str, deque]" = OrderedDict()
+        self.waiting = 0
+        self.admitted = self.rejected = self.timed_out = 0
+        self.max_depth = 0
+        self.wait_total = 0.0
+
+    def _user_ok(self, user: str) -> bool:
+        return self.per_user <= 0 or self.active_by_user.get(user, 0) < self.per_user
+
+    def _global_ok(self) -> bool:
+        return self.limit <= 0 or self.active < self.limit
+
+    def _grant(self, user: str):
+        self.active += 1
+        self.active_by_user[user] = self.active_by_user.get(user, 0) + 1
+        self.admitted += 1
+
+    def _dispatch(self):
+        # uma vaga por usuário a cada passada; quem foi atendido vai para o fim da fila
+        progressed = True
+        while progressed and self._waiting and self._global_ok():
+            progressed = False
+            for user in list(self._waiting):
+                if not self._global_ok():
+                    return
+                if not self._user_ok(user):
+                    continue
+                queue = self._waiting[user]
+                fut = queue.popleft()
+                self.waiting -= 1
+                if queue:
+                    self._waiting.move_to_end(user)
+                else:
+                    del self._waiting[user]
+                if fut.done():
+                    continue
+                self._grant(user)
+                fut.set_result(None)
+                progressed = True
+
+    def _forget(self, user: str, fut: asyncio.Future):
+        queue = self._waiting.get(user)
+        if queue and fut in queue:
+            queue.remove(fut)
+            self.waiting -= 1
+            if not queue:
+                del self._waiting[user]
+
+    async def acquire(self, user: str):
+        if not self._waiting and self._global_ok() and self._user_ok(user):
+            self._grant(user)
+            FLOWISE_ADMISSION_WAIT.observe(0.0)
+            return
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise AdmissionRejected("fila cheia")
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user, deque()).append(fut)
+        self.waiting += 1
+        self.max_depth = max(self.max_depth, self.waiting)
+        self._dispatch()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(fut, self.wait_timeout if self.wait_timeout > 0 else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():
+                self.release(user)  # vaga concedida no mesmo instante: devolve
+            else:
+                self._forget(user, fut)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise AdmissionRejected("tempo de espera esgotado")
+            raise
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        FLOWISE_ADMISSION_WAIT.observe(waited)
+
+    def release(self, user: str):
+        self.active -= 1
+        left = self.active_by_user.get(user, 1) - 1
+        if left > 0:
+            self.active_by_user[user] = left
+        else:
+            self.active_by_user.pop(user, None)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user: str):
+        await self.acquire(user)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"active": self.active, "limit": self.limit, "per_user": self.per_user,
+                "waiting": self.waiting, "users_waiting": len(self._waiting), "max_waiting": self.max_waiting,
+                "wait_timeout": self.wait_timeout, "max_depth": self.max_depth, "admitted": self.admitted,
+                "rejected": self.rejected, "timed_out": self.timed_out,
+                "avg_wait": round(self.wait_total / self.admitted, 3) if self.admitted else 0.0}
+
+
+FLOWISE_ADMISSION = AdmissionController(FLOWISE_CONCURRENCY, FLOWISE_PER_USER, FLOWISE_QUEUE_MAX, FLOWISE_QUEUE_TIMEOUT)
 
 
 async def call_flowise_with_session(prompt: str, session_id: str, user_name: str, user_email: str) -> str:
-    url = FLOWISE_PREDICTION_URL or (f"{FLOWISE_URL.rstrip('/')}/api/v1/prediction/{FLOWISE_CHATFLOW_ID}" if (FLOWISE_URL and FLOWISE_CHATFLOW_ID) else None)
+    url = flowise_url()
     if not url:
         return "(Flowise não configurado)"
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
@@ -653,35 +2532,29 @@ async def call_flowise_with_session(prompt: str, session_id: str, user_name: str
         "overrideConfig": {"sessionId": session_id, "vars": {"userName": user_name, "userEmail": user_email}},
         "responseMode": "blocking",
     }
-    for attempt in range(3):
+    resp, err = await _post_flowise(url, headers, payload, FLOWISE_TIMEOUT)
+    if resp is None:
+        return err
+    body_text = (resp.text or "").strip()
+    if resp.status_code >= 400:
         try:
-            timeout = 90.0 if attempt == 0 else 120.0
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                resp = await client.post(url, headers=headers, json=payload)
-                body_text = (resp.text or "").strip()
-                if resp.status_code >= 400:
-                    if attempt < 2:
-                        continue
-                    try:
-                        data = resp.json()
-                        msg = data.get("message") if isinstance(data, dict) else None
-                    except Exception:
-                        msg = None
-                    return f"(Flowise indisponível) HTTP {resp.status_code}: {msg or (body_text[:240] or 'sem corpo')}"
-                try:
-                    data = resp.json()
-                    reply = (data.get("text") or data.get("message") or data.get("data")) if isinstance(data, dict) else data
-                    return reply if isinstance(reply, str) else json.dumps(reply)
-                except Exception:
-                    return body_text[:500] or "(Flowise retornou corpo vazio)"
-        except Exception as e:
-            if attempt == 2:
-                return f"(Flowise indisponível) Erro: {e}"
-            continue
+            data = resp.json()
+            msg = data.get("message") if isinstance(data, dict) else None
+        except Exception:
+            msg = None
+        return f"(Flowise indisponível) HTTP {resp.status_code}: {msg or (body_text[:240] or 'sem corpo')}"
+    try:
+        data = resp.json()
+        reply = (data.get("text") or data.get("message") or data.get("data")) if isinstance(data, dict) else data
+        return reply if isinstance(reply, str) else json.dumps(reply)
+    except Exception:
+        return body_text[:500] or "(Flowise retornou corpo vazio)"
+
+
 async def call_flowise(prompt: str, user_id: str, user_name: str, user_email: str) -> str:
-    if not (FLOWISE_PREDICTION_URL or (FLOWISE_URL and FLOWISE_CHATFLOW_ID)):
+    url = flowise_url()
+    if not url:
         return "(Flowise não configurado) Defina FLOWISE_PREDICTION_URL ou FLOWISE_URL + FLOWISE_CHATFLOW_ID no .env."
-    url = FLOWISE_PREDICTION_URL or f"{FLOWISE_URL.rstrip('/')}/api/v1/prediction/{FLOWISE_CHATFLOW_ID}"
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
     payload = {
         "question": prompt,
@@ -697,33 +2570,659 @@ async def call_flowise(prompt: str, user_id: str, user_name: str, user_email: st
         },
     }
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            ct = resp.headers.get("content-type", "")
-            body_text = (resp.text or "").strip()
-            print(f"[Flowise] POST {url} -> {resp.status_code} {ct}")
-            if body_text:
-                print(f"[Flowise] body (head 300): {body_text[:300]}")
-            if resp.status_code >= 400:
-                try:
-                    data = resp.json()
-                    msg = (data.get("message") or data.get("error") or data.get("text") or data.get("detail")) if isinstance(data, dict) else None
-                    return f"(Flowise indisponível) HTTP {resp.status_code}: {msg or (body_text[:240] or str(data))}"
-                except Exception:
-                    return f"(Flowise indisponível) HTTP {resp.status_code}. Corpo: {body_text[:240] or '(vazio)'}"
-            if "application/json" in ct.lower():
-                try:
+        async with FLOWISE_ADMISSION.slot(str(user_id)):
+            resp, err = await _post_flowise(url, headers, payload, 60.0, mode="start")
+        if resp is None:
+            print(f"[Flowise] POST {url} -> {err}")
+            return err
+        ct = resp.headers.get("content-type", "")
+        body_text = (resp.text or "").strip()
+        print(f"[Flowise] POST {url} -> {resp.status_code} {ct}")
+        if body_text:
+            print(f"[Flowise] body (head 300): {body_text[:300]}")
+        if resp.status_code >= 400:
+            try:
+                data = resp.json()
+                msg = (data.get("message") or data.get("error") or data.get("text") or data.get("detail")) if isinstance(data, dict) else None
+                return f"(Flowise indisponível) HTTP {resp.status_code}: {msg or (body_text[:240] or str(data))}"
+            except Exception:
+                return f"(Flowise indisponível) HTTP {resp.status_code}. Corpo: {body_text[:240] or '(vazio)'}"
+        if "application/json" in ct.lower():
+            try:
+                data = resp.json()
+                reply = (data.get("text") or data.get("message") or data.get("data")) if isinstance(data, dict) else data
+                return reply if isinstance(reply, str) else json.dumps(reply)
+            except Exception as e:
+                return f"(Flowise indisponível) Resposta JSON inválida: {e}. Corpo: {body_text[:240]}"
+        return body_text[:500] or "(Flowise retornou corpo vazio)"
+    except AdmissionRejected:
+        return FLOWISE_BUSY_MSG
+    except Exception as e:
+        return f"(Flowise indisponível) Erro: {e}"
+
+async def stream_flowise_with_session(prompt: str, session_id: str, user_name: str, user_email: str) -> AsyncIterator[str]:
+    # Mesmo payload de call_flowise_with_session, mas com streaming=True: repassa os tokens
+    # do SSE do Flowise à medida que chegam. Se falhar antes do 1º token, cai no modo blocking.
+    url = flowise_url()
+    if not url:
+        yield "(Flowise não configurado)"
+        return
+    headers = {"Content-Type": "application/json", "Accept": "text/event-stream"}
+    payload = {
+        "question": prompt,
+        "overrideConfig": {"sessionId": session_id, "vars": {"userName": user_name, "userEmail": user_email}},
+        "streaming": True,
+    }
+    if not FLOWISE_BREAKER.allow():
+        FLOWISE_RESPONSES.inc("stream", "breaker_open")
+        yield FLOWISE_OPEN_MSG
+        return
+    sent = False
+    received = 0
+    started = time.perf_counter()
+    with span("flowise.stream", **{"prompt.chars": len(prompt)}) as sp:
+        try:
+            client = get_flowise_client()
+            async with client.stream("POST", url, headers=headers, json=payload, timeout=_flowise_timeout(FLOWISE_TIMEOUT)) as resp:
+                FLOWISE_RESPONSES.inc("stream", resp.status_code)
+                if sp is not None:
+                    sp.set("http.status_code", resp.status_code)
+                if _is_retryable_status(resp.status_code):
+                    FLOWISE_BREAKER.failure()
+                else:
+                    FLOWISE_BREAKER.success()
+                ct = resp.headers.get("content-type", "").lower()
+                if resp.status_code < 400 and "text/event-stream" in ct:
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        try:
+                            evt = json.loads(line[5:].strip())
+                        except Exception:
+                            continue
+                        if not isinstance(evt, dict):
+                            continue
+                        kind, data = evt.get("event"), evt.get("data")
+                        if kind == "token" and isinstance(data, str) and data:
+                            sent = True
+                            received += len(data)
+                            yield data
+                        elif kind == "error":
+                            yield f"(Flowise indisponível) {data}"
+                            return
+                        elif kind == "end":
+                            break
+                    if sent:
+                        return
+                elif resp.status_code < 400 and "application/json" in ct:
+                    # chatflow sem suporte a streaming: Flowise responde o JSON completo
+                    await resp.aread()
                     data = resp.json()
                     reply = (data.get("text") or data.get("message") or data.get("data")) if isinstance(data, dict) else data
-                    return reply if isinstance(reply, str) else json.dumps(reply)
+                    reply = reply if isinstance(reply, str) else json.dumps(reply)
+                    received = len(reply)
+                    yield reply
+                    return
+        except Exception as e:
+            FLOWISE_RESPONSES.inc("stream", "timeout" if isinstance(e, httpx.TimeoutException) else "error")
+            if isinstance(e, httpx.TransportError) and not isinstance(e, httpx.PoolTimeout):
+                FLOWISE_BREAKER.failure()
+            if sent:
+                yield f"\n\n(Flowise indisponível) Erro: {e}"
+                return
+        finally:
+            FLOWISE_SECONDS.observe(time.perf_counter() - started, "stream")
+            if sp is not None:
+                sp.set("response.chars", received)
+    yield await call_flowise_with_session(prompt, session_id, user_name, user_email)
+
+
+# Cache persistente de respostas (SQLite): endereçado pelo hash de chatflow + prompt final.
+# Diagnóstico/PDI com os mesmos dados voltam na hora, sem nova chamada ao Flowise.
+class PromptCache:
+    def __init__(self, path: str, ttl: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = self.misses = self.evicted = 0
+
+    @property
+    def _conn(self):
+        # aberto sob demanda; chamar com self._lock
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache ("
+                " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS prompt_cache_lru ON prompt_cache (last_access)")
+        return self._db
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        return hashlib.sha256(f"{flowise_url() or ''}\0{prompt}".encode()).hexdigest()
+
+    def get(self, prompt: str) -> Optional[str]:
+        key, now = self.key(prompt), time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM prompt_cache WHERE key = ?", (key,)).fetchone()
+            if row and row[1] + self.ttl > now:
+                self._conn.execute("UPDATE prompt_cache SET last_access = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0]
+            if row:
+                self._conn.execute("DELETE FROM prompt_cache WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+
+    def put(self, prompt: str, response: str) -> None:
+        key, now = self.key(prompt), time.time()
+        size = len(response.encode())
+        with self._lock:
+            conn = self._conn
+            conn.execute(
+                "INSERT INTO prompt_cache (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET response = excluded.response, size = excluded.size,"
+                " created_at = excluded.created_at, last_access = excluded.last_access",
+                (key, response, size, now, now),
+            )
+            conn.execute("DELETE FROM prompt_cache WHERE created_at + ? <= ?", (self.ttl, now))
+            # LRU: remove os menos acessados até caber no limite
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM prompt_cache").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                for old_key, old_size in conn.execute("SELECT key, size FROM prompt_cache ORDER BY last_access").fetchall():
+                    if excess <= 0:
+                        break
+                    conn.execute("DELETE FROM prompt_cache WHERE key = ?", (old_key,))
+                    excess -= old_size
+                    self.evicted += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM prompt_cache").fetchone()
+        return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses, "evicted": self.evicted}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+PROMPT_CACHE: Optional[PromptCache] = (
+    PromptCache(PROMPT_CACHE_PATH, PROMPT_CACHE_TTL, PROMPT_CACHE_MAX_MB * 1024 * 1024) if PROMPT_CACHE_ENABLED else None
+)
+
+
+@app.on_event("shutdown")
+async def _shutdown_prompt_cache():
+    if PROMPT_CACHE is not None:
+        PROMPT_CACHE.close()
+
+
+# Single-flight: requests idênticos (mesmo sessionId + mesmo prompt) compartilham uma
+# única chamada ao Flowise; o resultado fica disponível por SINGLEFLIGHT_RESULT_TTL s
+# para quem reenviar depois de um timeout no cliente.
+class Flight:
+    """Geração em andamento (ou recém-concluída) compartilhada por vários requests."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.expires_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def push(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[str]:
+        # repassa tudo desde o início e depois cada novo trecho, até o fim da geração
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def text(self) -> str:
+        while not self.done:
+            await self._changed.wait()
+        return "".join(self.chunks)
+
+
+_FLIGHTS: Dict[str, Flight] = {}
+
+
+def is_flowise_error(text: str) -> bool:
+    return text.lstrip().startswith("(Flowise") or "\n\n(Flowise indisponível)" in text
+
+
+def _flight_key(session_id: str, prompt: str) -> str:
+    return hashlib.sha256(f"{session_id}\0{prompt}".encode()).hexdigest()
+
+
+def _prune_flights():
+    now = time.monotonic()
+    for key in [k for k, f in _FLIGHTS.items() if f.done and f.expires_at <= now]:
+        del _FLIGHTS[key]
+
+
+async def _run_flight(key: str, flight: Flight, prompt: str, session_id: str, user_name: str, user_email: str,
+                      stream: bool, user_id: str):
+    with span("generation", **{"generation.stream": stream, "prompt.chars": len(prompt)}) as sp:
+        try:
+            async with FLOWISE_ADMISSION.slot(user_id):
+                if stream:
+                    async for chunk in stream_flowise_with_session(prompt, session_id, user_name, user_email):
+                        flight.push(chunk)
+                else:
+                    flight.push(await call_flowise_with_session(prompt, session_id, user_name, user_email))
+        except AdmissionRejected as e:
+            print(f"[Flowise] Geração recusada ({e}): {FLOWISE_ADMISSION.stats()}")
+            flight.push(FLOWISE_BUSY_MSG)
+        except Exception as e:
+            flight.push(f"(Flowise indisponível) Erro: {e}")
+        finally:
+            flight.finish()
+            text = "".join(flight.chunks)
+            failed = is_flowise_error(text)
+            if sp is not None:
+                sp.set("response.chars", len(text))
+                sp.set("generation.failed", failed)
+            if failed or SINGLEFLIGHT_RESULT_TTL <= 0:
+                if _FLIGHTS.get(key) is flight:
+                    del _FLIGHTS[key]  # erro não é reaproveitado: o próximo reenvio tenta de novo
+            else:
+                flight.expires_at = time.monotonic() + SINGLEFLIGHT_RESULT_TTL
+            if PROMPT_CACHE is not None and not failed and text.strip():
+                try:
+                    await asyncio.to_thread(PROMPT_CACHE.put, prompt, text)
                 except Exception as e:
-                    return f"(Flowise indisponível) Resposta JSON inválida: {e}. Corpo: {body_text[:240]}"
-            return body_text[:500] or "(Flowise retornou corpo vazio)"
-    except Exception as e:
-        return f"(Flowise indisponível) Erro: {e}"
+                    print(f"[Cache] Falha ao gravar resposta: {e}")
+
+
+def _joinable_flight(key: str, use_cache: bool) -> Optional[Flight]:
+    # use_cache=False ("regenerate"): só entra numa geração ainda em andamento; a resposta
+    # já concluída é descartada para que uma nova chamada ao Flowise seja feita
+    flight = _FLIGHTS.get(key)
+    if flight is not None and flight.done and not use_cache:
+        del _FLIGHTS[key]
+        return None
+    return flight
+
+
+async def start_generation(prompt: str, session_id: str, user_name: str, user_email: str,
+                           stream: bool = False, use_cache: bool = True, user_id: str = "") -> Flight:
+    # A geração roda numa task própria: se o cliente desconectar, ela termina mesmo assim
+    # e o resultado fica guardado para o próximo reenvio.
+    _prune_flights()
+    key = _flight_key(session_id, prompt)
+    flight = _joinable_flight(key, use_cache)
+    if flight is not None:
+        set_span_attr("generation.source", "joined")
+        return flight
+    if PROMPT_CACHE is not None and use_cache:
+        try:
+            cached = await asyncio.to_thread(PROMPT_CACHE.get, prompt)
+        except Exception as e:
+            print(f"[Cache] Falha ao ler resposta: {e}")
+            cached = None
+        if cached is not None:
+            set_span_attr("generation.source", "prompt_cache")
+            flight = Flight()
+            flight.push(cached)
+            flight.finish()
+            return flight
+        flight = _joinable_flight(key, use_cache)  # outro request pode ter iniciado durante a leitura
+        if flight is not None:
+            set_span_attr("generation.source", "joined")
+            return flight
+    set_span_attr("generation.source", "flowise")
+    flight = Flight()
+    _FLIGHTS[key] = flight
+    flight.task = asyncio.create_task(_run_flight(key, flight, prompt, session_id, user_name, user_email, stream,
+                                               user_id or session_id))
+    return flight
+
+
+def flights_stats() -> Dict[str, int]:
+    running = sum(1 for f in _FLIGHTS.values() if not f.done)
+    return {"running": running, "cached": len(_FLIGHTS) - running}
+
 
 # ================= Estado da Conversa (roteiro) =================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+class SessionStore(ABC):
+    """Interface do armazenamento de sessões do roteiro (valores são dicts JSON-serializáveis)."""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    async def sweep(self) -> int:
+        # remove sessões expiradas; backends com TTL nativo não precisam
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__}
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    # Dict local do processo (só serve para 1 worker/1 réplica), limitado por
+    # TTL de inatividade e por número de entradas (LRU).
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.expired = 0
+        self.evicted = 0
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        now = time.monotonic()
+        if expires_at <= now:
+            self._data.pop(key, None)
+            self.expired += 1
+            return None
+        # acesso conta como atividade: renova o TTL e vai para o fim da fila LRU
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        # cópias, como nos outros backends: a sessão só muda via set()
+        return copy.deepcopy(value)
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def sweep(self) -> int:
+        # ordem LRU == ordem de expiração (TTL fixo renovado a cada acesso)
+        now = time.monotonic()
+        removed = 0
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+            removed += 1
+        self.expired += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "expired": self.expired,
+            "evicted_lru": self.evicted,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    # Arquivo local compartilhado entre workers da mesma máquina (WAL)
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def _conn(self):
+        # aberto sob demanda (e reaberto após close()); chamar com self._lock
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM sessions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= time.time():
+                self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+                return None
+        return json.loads(row[0])
+
+    def _set(self, key: str, value: Dict[str, Any]) -> None:
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, data, time.time() + self.ttl),
+            )
+
+    def _delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    async def sweep(self) -> int:
+        return await asyncio.to_thread(self.purge_expired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": self.path, "ttl": self.ttl}
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._set, key, value)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._delete, key)
+
+    async def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisSessionStore(SessionStore):
+    # Cliente mínimo do protocolo Redis (RESP2): GET / SET EX / DEL, sem dependência extra.
+    # Uma conexão por worker, comandos serializados por um lock; cada comando tem prazo
+    # (`timeout`) para não prender o lock, e todos os turnos do worker, num Redis travado.
+    def __init__(self, url: str, ttl: int, prefix: str = "pdi:sess:", timeout: float = 2.0):
+        from urllib.parse import urlparse
+        u = urlparse(url)
+        self.host = u.hostname or "localhost"
+        self.port = u.port or 6379
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.username = u.username or None
+        self.password = u.password or None
+        self.ssl = u.scheme == "rediss"
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args: Any) -> bytes:
+        out = [f"*{len(args)}\r\n".encode()]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        return b"".join(out)
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("conexão Redis encerrada")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            data = await self._reader.readexactly(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [await self._read_reply() for _ in range(size)]
+        raise RedisError(f"resposta RESP inesperada: {line[:40]!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl or None), timeout=self.timeout
+        )
+        if self.password:
+            auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+            await self._roundtrip(*auth)
+        if self.db:
+            await self._roundtrip("SELECT", self.db)
+
+    async def _roundtrip(self, *args: Any) -> Any:
+        self._writer.write(self._encode(*args))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _attempt(self, *args: Any) -> Any:
+        if self._writer is None or self._writer.is_closing():
+            await self._connect()
+        return await self._roundtrip(*args)
+
+    async def command(self, *args: Any) -> Any:
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    return await asyncio.wait_for(self._attempt(*args), self.timeout)
+                except asyncio.TimeoutError:
+                    # resposta pode chegar depois e dessincronizar a conexão: descarta; sem nova
+                    # tentativa (o comando pode ter sido aplicado)
+                    await self._drop()
+                    raise RedisError(f"Redis sem resposta em {self.timeout:g}s ({args[0]})")
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    await self._drop()
+                    if attempt == 1:
+                        raise
+
+    async def _drop(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+        self._reader = self._writer = None
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.command("GET", self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        await self.command("SET", self.prefix + key, json.dumps(value, ensure_ascii=False), "EX", self.ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.command("DEL", self.prefix + key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "host": self.host, "db": self.db, "ttl": self.ttl}
+
+    async def close(self) -> None:
+        async with self._lock:
+            await self._drop()
+
+
+def _build_session_store() -> SessionStore:
+    backend = SESSION_BACKEND.lower()
+    if backend == "memory":
+        return MemorySessionStore(SESSION_TTL, SESSION_MAX_ENTRIES)
+    if backend == "sqlite":
+        return SQLiteSessionStore(SESSION_SQLITE_PATH, SESSION_TTL)
+    if backend == "redis":
+        return RedisSessionStore(SESSION_REDIS_URL, SESSION_TTL, timeout=SESSION_REDIS_TIMEOUT)
+    raise RuntimeError(f"SESSION_BACKEND inválido: {SESSION_BACKEND!r} (use memory, sqlite ou redis)")
+
+
+SESSIONS: SessionStore = _build_session_store()
+_SESSION_SWEEPER: Optional[asyncio.Task] = None
+
+
+async def _sweep_sessions_forever():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            removed = await SESSIONS.sweep()
+            if removed:
+                print(f"[Sessões] {removed} sessões expiradas removidas")
+        except Exception as e:
+            print(f"[Sessões] Falha na limpeza: {e}")
+
+
+@app.on_event("startup")
+async def _startup_sessions():
+    global _SESSION_SWEEPER
+    if SESSION_SWEEP_INTERVAL > 0:
+        _SESSION_SWEEPER = asyncio.create_task(_sweep_sessions_forever())
+
+
+@app.on_event("shutdown")
+async def _shutdown_sessions():
+    # jobs primeiro: os pendentes são marcados como erro e publicados antes de fechar o SESSIONS
+    await _shutdown_jobs()
+    if _SESSION_SWEEPER is not None:
+        _SESSION_SWEEPER.cancel()
+    await SESSIONS.close()
+
 
 ROTEIRO = [
     {"key": INFO_TAGS_PF,     "pergunta": "Aponte resumidamente seus principais pontos fortes:"},
@@ -753,121 +3252,447 @@ Retorne esse diagnóstico com a seguinte estrutura e oferecendo argumentos e os
 4- Indicações de pontos de desenvolvimento:(Citando competências, habilidades e atitudes que dado as informações a pessoa deveria considerar desenvolver, bem como os motivos. Foque apenas em sugestões sem montar um PDI ou usar o 70 20 10. é apenas recomendação.)
 """
 
+# {resultado} e {resumos_semanal} entram uma única vez; as seções seguintes se referem a eles
+PROMPT_PDI = """
+Você é um especialista em desenvolvimento de carreira e deverá criar um Plano de Desenvolvimento Individual (PDI) de alta qualidade.
+
+Use as informações do diagnóstico inicial abaixo como base para montar o PDI:
+
+{diagnostico}
+
+Tarefas atuais da pessoa: {resultado}
+
+Relatórios semanais da pessoa:
+{resumos_semanal}
+
+Utilize essas tarefas e relatórios semanais (informações reais) para sugerir atividades práticas que façam sentido no contexto do dia a dia da pessoa.
+
+Estruture o PDI no modelo 70-20-10, separado por competência para os seguintes pontos de desenvolvimento escolhidos pela pessoa {focos_desenvolvimento}.
+Para cada competência identificada no diagnóstico, siga esta estrutura:
+
+### Competência: [nome da competência]
+
+**Objetivo de Desenvolvimento**
+Descreva o objetivo principal para esta competência, resumido em 2-3 linhas.
+
+**70% Atividades práticas (on the job)**
+Liste de 3 a 5 atividades diretamente conectadas às tarefas e aos relatórios semanais da pessoa.
+Cada atividade deve ser descrita no formato SMART.
+
+**20% Aprendizagem com os outros**
+Liste de 2 a 4 atividades informais (mentorias, feedbacks, shadowing etc.), conectadas às tarefas e aos relatórios semanais, no formato SMART.
+
+**10% Cursos e treinamentos**
+Indique de 1 a 3 formações formais relacionadas à competência.
+
+--- Regras ---
+- O PDI deve ter múltiplas competências, cada uma com sua própria estrutura.
+- Nas seções 70% e 20%, use as tarefas e os relatórios semanais para alinhar à realidade.
+- Todas as metas devem estar no formato SMART.
+- Conecte os objetivos de desenvolvimento ao impacto esperado no negócio.
+"""
+
+
+# ================= Orçamento de prompt =================
+# Os resumos semanais crescem com o tempo de casa; sem teto, o prompt (e a latência/custo
+# do Flowise) cresce junto. Tokens são estimados por caracteres, sem depender de tokenizer.
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / PROMPT_CHARS_PER_TOKEN + 0.999)
+
+
+def clip_to_tokens(text: str, max_tokens: int) -> str:
+    limit = int(max_tokens * PROMPT_CHARS_PER_TOKEN)
+    if max_tokens <= 0 or len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(" ", 1)[0]
+    return cut.rstrip(" ,;-") + "…"
+
+
+def compact_resumos(text: str, max_tokens: int) -> str:
+    """Encaixa os resumos semanais (um por linha, mais antigo primeiro) em `max_tokens`.
+
+    As semanas mais recentes entram inteiras; quando não cabem mais, as anteriores entram
+    cortadas em PROMPT_RESUMO_CLIP_CHARS e, acabando o espaço, são omitidas com um aviso.
+    """
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+    lines = [l for l in text.splitlines() if l.strip()]
+    budget = int(max_tokens * PROMPT_CHARS_PER_TOKEN) - 60  # reserva para o aviso de omitidos
+    kept: List[str] = []
+    used, clipping = 0, False
+    for line in reversed(lines):
+        if not clipping and used + len(line) + 1 <= budget:
+            kept.append(line)
+        else:
+            clipping = True
+            line = clip_to_tokens(line, int(PROMPT_RESUMO_CLIP_CHARS / PROMPT_CHARS_PER_TOKEN))
+            if used + len(line) + 1 > budget:
+                if not kept and budget > 0:
+                    kept.append(clip_to_tokens(line, int(budget / PROMPT_CHARS_PER_TOKEN)))
+                break
+            kept.append(line)
+        used += len(kept[-1]) + 1
+    omitted = len(lines) - len(kept)
+    kept.reverse()
+    if omitted:
+        kept.insert(0, f"({omitted} resumo(s) semanal(is) mais antigo(s) omitido(s))")
+    return "\n".join(kept)
+
+
+def build_prompt(kind: str, template: str, **fields: str) -> str:
+    """Formata `template` respeitando os orçamentos e registra o tamanho final (métrica e span)."""
+    if fields.get("historico_bot"):
+        fields["historico_bot"] = clip_to_tokens(fields["historico_bot"], PROMPT_HISTORICO_MAX_TOKENS)
+    resumos = fields.get("resumos_semanal") or ""
+    if resumos:
+        fields["resumos_semanal"] = compact_resumos(resumos, PROMPT_RESUMOS_MAX_TOKENS)
+    prompt = template.format(**fields)
+    over = estimate_tokens(prompt) - PROMPT_MAX_TOKENS
+    if PROMPT_MAX_TOKENS > 0 and over > 0 and resumos:
+        # passou do teto geral: os resumos semanais cedem o espaço que faltar (ou saem inteiros;
+        # compact_resumos com 0 significaria "sem limite")
+        budget = estimate_tokens(fields["resumos_semanal"]) - over
+        if budget > 0:
+            fields["resumos_semanal"] = compact_resumos(resumos, budget)
+        else:
+            n = sum(1 for l in resumos.splitlines() if l.strip())
+            fields["resumos_semanal"] = f"({n} resumo(s) semanal(is) omitido(s) por limite de tamanho)"
+        prompt = template.format(**fields)
+    tokens = estimate_tokens(prompt)
+    PROMPT_TOKENS.observe(tokens, kind)
+    set_span_attr("prompt.tokens_est", tokens)
+    if PROMPT_MAX_TOKENS > 0 and tokens > PROMPT_MAX_TOKENS:
+        # o que sobrou (diagnóstico, respostas da pessoa) não é cortado: só avisa
+        set_span_attr("prompt.over_budget", True)
+        print(f"[Prompt] {kind}: ~{tokens} tokens acima de PROMPT_MAX_TOKENS={PROMPT_MAX_TOKENS} mesmo sem os resumos semanais")
+    if estimate_tokens(resumos) > estimate_tokens(fields.get("resumos_semanal") or ""):
+        set_span_attr("prompt.resumos_compacted", True)
+    return prompt
+
 # ================= Rotas =================
+# O HTML do widget é montado e comprimido uma vez por processo; cada acesso só escolhe
+# a variante (br/gzip/identity) e responde 304 quando o ETag bate.
+def _build_widget_variants() -> Dict[str, Tuple[bytes, str]]:
+    defaults = json.dumps({"id": DEFAULT_USER_ID, "name": DEFAULT_USER_NAME, "email": DEFAULT_USER_EMAIL},
+                          ensure_ascii=False).replace("</", "<\\/")
+    body = INDEX_HTML.replace("__DEFAULT_USER__", defaults).encode("utf-8")
+    digest = hashlib.sha256(body).hexdigest()[:20]
+    variants = {"identity": (body, f'"{digest}"'), "gzip": (gzip.compress(body, 9, mtime=0), f'"{digest}-gz"')}
+    if brotli is not None:
+        variants["br"] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+    return variants
+
+
+_WIDGET_VARIANTS = _build_widget_variants()
+
+
 @app.get("/", response_class=HTMLResponse)
-async def index(
-    user_id: Optional[str] = Query(default=DEFAULT_USER_ID, description="ID do usuário"),
-    user_name: Optional[str] = Query(default=DEFAULT_USER_NAME, description="Nome do usuário"),
-    user_email: Optional[str] = Query(default=DEFAULT_USER_EMAIL, description="Email do usuário")
-):
-    html = INDEX_HTML
-    #html = html.replace("__FLOWISE_URL__", FLOWISE_URL)
-    #html = html.replace("__FLOWISE_CHATFLOW_ID__", FLOWISE_CHATFLOW_ID)
-    html = html.replace("__USER_ID__", user_id)
-    html = html.replace("__USER_NAME__", user_name)
-    html = html.replace("__USER_EMAIL__", user_email)
-    return HTMLResponse(html)
+async def index(req: Request):
+    # user_id/user_name/user_email continuam na query string, mas são lidos pelo JS do widget
+    accepted = _accepted_encodings(req.headers.get("accept-encoding", ""))
+    encoding = next((e for e in ("br", "gzip") if e in _WIDGET_VARIANTS and e in accepted), "identity")
+    body, etag = _WIDGET_VARIANTS[encoding]
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={WIDGET_MAX_AGE}, stale-while-revalidate=86400",
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = req.headers.get("if-none-match", "")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
+
+@dataclass
+class Generation:
+    """Chamada longa ao Flowise (diagnóstico/PDI) que fecha o turno.
+
+    Fica gravada na sessão (`pending`) até terminar: reenvio ou recarga do widget
+    durante a geração reaproveita a mesma chamada em vez de disparar outra.
+    """
+    kind: str  # "diagnosis" | "pdi"
+    user_id: str
+    prompt: str
+    session_id: str
+    user_name: str
+    user_email: str
+    prefix: str = ""
+    suffix: str = ""
+    use_cache: bool = True  # False = ignora o cache de respostas ("regenerate" no payload)
+
+
+async def finish_generation(gen: Generation, resposta: str):
+    if gen.kind == "pdi":
+        # PDI entregue: encerra a sessão
+        await SESSIONS.delete(gen.user_id)
+        return
+    sess = await SESSIONS.get(gen.user_id)
+    if not sess:
+        return
+    # guarda diagnóstico e pede as competências (não encerra a sessão)
+    sess.pop("pending", None)
+    sess.pop("pending_at", None)
+    sess["diagnosis"] = resposta
+    sess["await_competencies"] = True
+    await SESSIONS.set(gen.user_id, sess)
+
+
+# ================= Jobs (geração assíncrona) =================
+# Modo job: /api/message devolve um job_id na hora e a geração roda num pool fixo de
+# workers; o cliente consulta GET /api/jobs/{id} até status "done".
+@dataclass
+class Job:
+    id: str
+    gen: Generation
+    status: str = "queued"  # queued | running | done | error
+    reply: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = 0.0
+    finished_at: Optional[float] = None
+    parent_span: Optional[Span] = None  # span da requisição que criou o job (tracing)
+
+    def public(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"job_id": self.id, "status": self.status}
+        if self.reply is not None:
+            data["reply"] = self.reply
+        if self.error is not None:
+            data["error"] = self.error
+        return data
+
+
+class JobQueueFull(Exception):
+    pass
 
-@app.post("/api/message")
-async def api_message(req: Request):
+
+JOBS: Dict[str, Job] = {}
+# com sqlite/redis o estado do job também vai para o SESSIONS: o polling pode cair em outro worker
+_JOBS_SHARED = not isinstance(SESSIONS, MemorySessionStore)
+_JOB_BY_KEY: Dict[str, str] = {}  # flight key -> job ativo (reenvio reaproveita o mesmo job)
+_JOB_QUEUE: Optional[asyncio.Queue] = None
+_JOB_WORKERS: List[asyncio.Task] = []
+
+
+def _prune_jobs():
+    now = time.time()
+    for job_id in [j.id for j in JOBS.values() if j.finished_at and j.finished_at + JOB_RESULT_TTL <= now]:
+        JOBS.pop(job_id, None)
+
+
+async def _publish_job(job: Job):
+    if not _JOBS_SHARED:
+        return
+    data = job.public()
+    if job.finished_at:
+        data["expires_at"] = job.finished_at + JOB_RESULT_TTL
+    try:
+        await SESSIONS.set(f"job:{job.id}", data)
+    except Exception as e:
+        print(f"[Jobs] Falha ao gravar o job {job.id} no SESSIONS: {e!r}")
+
+
+async def _load_job(job_id: str) -> Optional[Dict[str, Any]]:
+    job = JOBS.get(job_id)
+    if job is not None:
+        return job.public()
+    if not _JOBS_SHARED:
+        return None
+    data = await SESSIONS.get(f"job:{job_id}")
+    if not data:
+        return None
+    if data.pop("expires_at", time.time() + 1) <= time.time():
+        await SESSIONS.delete(f"job:{job_id}")
+        return None
+    return data
+
+
+async def _run_job(job: Job):
+    gen = job.gen
+    job.status = "running"
+    await _publish_job(job)
+    token = _CURRENT_SPAN.set(job.parent_span)  # gerações do job entram no trace da requisição
+    try:
+        flight = await start_generation(gen.prompt, gen.session_id, gen.user_name, gen.user_email,
+                                        use_cache=gen.use_cache, user_id=gen.user_id)
+        resposta = await flight.text()
+        await finish_generation(gen, resposta)
+        job.reply = f"{gen.prefix}{resposta}{gen.suffix}"
+        job.status = "done"
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"[Jobs] Falha no job {job.id}: {e!r}")
+        job.status = "error"
+        job.error = "Falha ao gerar a resposta. Tente novamente."
+    finally:
+        _CURRENT_SPAN.reset(token)
+        job.finished_at = time.time()
+        _JOB_BY_KEY.pop(_flight_key(gen.session_id, gen.prompt), None)
+    await _publish_job(job)
+
+
+async def _job_worker(queue: asyncio.Queue):
+    while True:
+        job = await queue.get()
+        try:
+            await _run_job(job)
+        finally:
+            queue.task_done()
+
+
+async def enqueue_generation(gen: Generation) -> Job:
+    if _JOB_QUEUE is None:
+        raise RuntimeError("fila de jobs não iniciada")
+    _prune_jobs()
+    key = _flight_key(gen.session_id, gen.prompt)
+    job = JOBS.get(_JOB_BY_KEY.get(key, ""))
+    if job is not None:
+        return job
+    job = Job(id=secrets.token_urlsafe(16), gen=gen, created_at=time.time(), parent_span=_CURRENT_SPAN.get())
+    try:
+        _JOB_QUEUE.put_nowait(job)
+    except asyncio.QueueFull:
+        raise JobQueueFull()
+    JOBS[job.id] = job
+    _JOB_BY_KEY[key] = job.id
+    await _publish_job(job)
+    return job
+
+
+def jobs_stats() -> Dict[str, Any]:
+    by_status: Dict[str, int] = {}
+    for job in JOBS.values():
+        by_status[job.status] = by_status.get(job.status, 0) + 1
+    return {"workers": len(_JOB_WORKERS), "queued": _JOB_QUEUE.qsize() if _JOB_QUEUE else 0,
+            "queue_max": JOB_QUEUE_MAX, "jobs": by_status}
+
+
+@app.on_event("startup")
+async def _startup_jobs():
+    global _JOB_QUEUE
+    _JOB_QUEUE = asyncio.Queue(maxsize=JOB_QUEUE_MAX)
+    _JOB_WORKERS[:] = [asyncio.create_task(_job_worker(_JOB_QUEUE)) for _ in range(JOB_WORKERS)]
+    if not _JOBS_SHARED and int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        print("[Jobs] ATENÇÃO: WEB_CONCURRENCY>1 com SESSION_BACKEND=memory; sessões e jobs ficam por "
+              "worker e GET /api/jobs/{id} pode dar 404 em outro worker. Use SESSION_BACKEND=sqlite ou redis.")
+
+
+async def _shutdown_jobs():
+    # chamado por _shutdown_sessions
+    global _JOB_QUEUE
+    for task in _JOB_WORKERS:
+        task.cancel()
+    await asyncio.gather(*_JOB_WORKERS, return_exceptions=True)
+    _JOB_WORKERS.clear()
+    for job in JOBS.values():
+        if job.status in ("queued", "running"):
+            job.status = "error"
+            job.error = "Servidor reiniciado. Tente novamente."
+            job.finished_at = time.time()
+            await _publish_job(job)
+    _JOB_BY_KEY.clear()
+    _JOB_QUEUE = None
+
+
+async def _read_message(req: Request) -> Tuple[str, str, str, str, bool]:
     try:
         payload = await req.json()
         raw = str(payload.get("text", ""))
         user_id = str(payload.get("user_id", DEFAULT_USER_ID))
         user_name = str(payload.get("user_name", DEFAULT_USER_NAME))
         user_email = str(payload.get("user_email", DEFAULT_USER_EMAIL))
+        regenerate = bool(payload.get("regenerate", False))
     except Exception:
         raw = ""
         user_id = DEFAULT_USER_ID
         user_name = DEFAULT_USER_NAME
         user_email = DEFAULT_USER_EMAIL
+        regenerate = False
+    return raw, user_id, user_name, user_email, regenerate
+
+
+def _is_start_command(n: str) -> bool:
+    return n == "1" or "montar pdi" in n or "monte pdi" in n or n == "pdi"
+
 
+async def run_turn(raw: str, user_id: str, user_name: str, user_email: str, regenerate: bool = False) -> Union[str, Generation]:
     n = normalize_text(raw)
 
+    set_turn_stage("menu")
+    set_span_attr("user.id", user_id)
+    sess_tmp = await SESSIONS.get(user_id)
+
+    # marca de geração antiga (cliente desconectou, outro worker, reinício) ou menu pedido de novo: descarta
+    if sess_tmp and sess_tmp.get("pending") and (
+        _is_start_command(n) or time.time() - sess_tmp.get("pending_at", 0) > GENERATION_PENDING_TTL
+    ):
+        sess_tmp.pop("pending", None)
+        sess_tmp.pop("pending_at", None)
+        await SESSIONS.set(user_id, sess_tmp)
+
+    # === Diagnóstico/PDI ainda sendo gerado: reenvio recebe a mesma geração ===
+    if sess_tmp and sess_tmp.get("pending"):
+        set_turn_stage(f"{sess_tmp['pending'].get('kind', 'generation')}_rejoin")
+        # o regenerate vale para este envio: recarregar a página não descarta uma resposta pronta
+        return Generation(**{**sess_tmp["pending"], "use_cache": not regenerate})
+
     # === Etapa pós-diagnóstico: aguardando competências (handler prioritário) ===
-    sess_tmp = SESSIONS.get(user_id)
     if sess_tmp and sess_tmp.get("await_competencies"):
+        set_turn_stage("pdi")
         comps_raw = raw.strip()
         comps = [c.strip() for c in comps_raw.split(";") if c.strip()]
         if len(comps) < 2:
-            return JSONResponse({"reply": "Digite DUAS competências separadas por ponto e vírgula (ex.: Comunicação; Planejamento)."})
+            return "Digite DUAS competências separadas por ponto e vírgula (ex.: Comunicação; Planejamento)."
         sess_tmp["await_competencies"] = False
         focos_desenvolvimento = "; ".join(comps[:2])
         sess_tmp["answers"][INFO_COMPETENCIAS] = focos_desenvolvimento
-        SESSIONS[user_id] = sess_tmp
 
         # Monta prompt de PDI no formato exato fornecido
         sess_email = sess_tmp.get("user_email", user_email)
         sess_name = sess_tmp.get("user_name", user_name)
-        valores, datas, ok_db, msg_db = get_latest_infos(sess_email)
-        ctx = format_profile_context(sess_email, sess_name, valores)
+        uctx = await load_user_context(sess_email)
+        ok_db, msg_db = uctx.ok_db, uctx.msg_db
         ans = sess_tmp.get("answers", {})
         resumo_pf = ans.get(INFO_TAGS_PF, "")
         resumo_pd = ans.get(INFO_TAGS_PD, "")
         objetivos = ans.get(INFO_OBJETIVOS, "")
         resultado = ans.get(INFO_TAREFAS, "")
-        resumos_semanal = get_resumos_semanal(sess_email)
+        resumos_semanal = uctx.resumos_semanal
         diagnostico_salvo = sess_tmp.get("diagnosis", "")
 
-        prompt_pdi = f"""
-        Você é um especialista em desenvolvimento de carreira e deverá criar um Plano de Desenvolvimento Individual (PDI) de alta qualidade.
-
-        Use as informações do diagnóstico inicial abaixo como base para montar o PDI:
-
-        {diagnostico_salvo}
-
-        Além disso, utilize as informações reais de {resultado} e {resumos_semanal} para sugerir atividades práticas que façam sentido no contexto do dia a dia da pessoa.
-
-        Estruture o PDI no modelo 70-20-10, separado por competência para os seguintes pontos de desenvolvimento escolhidos pela pessoa {focos_desenvolvimento}.
-        Para cada competência identificada no diagnóstico, siga esta estrutura:
-
-        ### Competência: [nome da competência]
-
-        **Objetivo de Desenvolvimento**
-        Descreva o objetivo principal para esta competência, resumido em 2-3 linhas.
-
-        **70% Atividades práticas (on the job)**
-        Liste de 3 a 5 atividades diretamente conectadas às {resultado} e {resumos_semanal} da pessoa.
-        Cada atividade deve ser descrita no formato SMART.
-
-        **20% Aprendizagem com os outros**
-        Liste de 2 a 4 atividades informais (mentorias, feedbacks, shadowing etc.), conectadas às {resultado} e {resumos_semanal}, no formato SMART.
-
-        **10% Cursos e treinamentos**
-        Indique de 1 a 3 formações formais relacionadas à competência.
-
-        --- Regras ---
-        - O PDI deve ter múltiplas competências, cada uma com sua própria estrutura.
-        - Nas seções 70% e 20%, use {resultado} e {resumos_semanal} para alinhar à realidade.
-        - Todas as metas devem estar no formato SMART.
-        - Conecte os objetivos de desenvolvimento ao impacto esperado no negócio.
-        """
+        prompt_pdi = build_prompt(
+            "pdi", PROMPT_PDI,
+            diagnostico=diagnostico_salvo,
+            resultado=resultado,
+            resumos_semanal=resumos_semanal,
+            focos_desenvolvimento=focos_desenvolvimento,
+        )
 
         # Chamada ao Flowise com sessionId id_pessoa:YYYY-MM-DD
-        resumo_pessoa, cargo_pessoa, id_pessoa = get_basic_profile(sess_email)
         from datetime import date
-        sess_id_override = f"{id_pessoa or user_id}:{date.today().isoformat()}"
-        resposta_pdi = await call_flowise_with_session(prompt_pdi, sess_id_override, sess_name, sess_email)
-
-        # Finaliza sessão e retorna
-        sess_tmp["started"] = False
-        SESSIONS[user_id] = sess_tmp
+        sess_id_override = f"{uctx.id_pessoa or user_id}:{date.today().isoformat()}"
         aviso_db = f"\n\n(Aviso: {msg_db})" if not ok_db else ""
-        return JSONResponse({"reply": f"{resposta_pdi}{aviso_db}"})
+        gen = Generation("pdi", user_id, prompt_pdi, sess_id_override, sess_name, sess_email, suffix=aviso_db,
+                         use_cache=not regenerate)
+        # grava só após carregar os dados: com DBBusy a pessoa reenvia sem perder a etapa
+        sess_tmp["pending"], sess_tmp["pending_at"] = asdict(gen), time.time()
+        await SESSIONS.set(user_id, sess_tmp)
+        return gen
 
     # === Início do fluxo ===
-    if n == "1" or "montar pdi" in n or "monte pdi" in n or n == "pdi":
-        valores, datas, ok_db, msg_db = get_latest_infos(user_email)
-        ctx = format_profile_context(user_email, user_name, valores)
+    if _is_start_command(n):
+        set_turn_stage("start")
+        uctx = await load_user_context(user_email)
+        valores, datas, ok_db, msg_db = uctx.valores, uctx.datas, uctx.ok_db, uctx.msg_db
+        ctx = format_profile_context(user_email, user_name, valores, uctx)
 
         # 1ª chamada ao Flowise (mensagem inicial do assistente)
-        prompt1 = f"[Contexto do usuário]\n{ctx}\n\n{START_PROMPT_FLOWISE}"
+        prompt1 = build_prompt("start", "[Contexto do usuário]\n{ctx}\n\n{instrucao}", ctx=ctx, instrucao=START_PROMPT_FLOWISE)
         inicio = await call_flowise(prompt1, user_id, user_name, user_email)
 
         # inicia sessão do roteiro
-        SESSIONS[user_id] = {"step": 0, "answers": {}, "started": True, "user_email": user_email, "user_name": user_name}
+        sess = {"step": 0, "answers": {}, "started": True, "user_email": user_email, "user_name": user_name}
         # Pré-preenche PF/PD/Objetivos com o que já existe no banco e esteja fresco
-        valores, datas, ok_db, msg_db = get_latest_infos(user_email)
         answers = {}
         from datetime import datetime, timezone, timedelta
         now = datetime.now(timezone.utc)
@@ -884,44 +3709,46 @@ async def api_message(req: Request):
         for k, v in pre_map.items():
             if v and _is_fresh(datas.get(k)):
                 answers[k] = v.strip()
-        SESSIONS[user_id]["answers"] = answers
+        sess["answers"] = answers
         step0 = 0
         for item in ROTEIRO:
             if item["key"] in answers and answers[item["key"]]:
                 step0 += 1
             else:
                 break
-        SESSIONS[user_id]["step"] = step0
+        sess["step"] = step0
+        await SESSIONS.set(user_id, sess)
         proxima = ROTEIRO[step0]["pergunta"] if step0 < len(ROTEIRO) else None
         aviso_db = f"\n\n(Aviso: {msg_db})" if not ok_db else ""
         if proxima:
-            return JSONResponse({"reply": f"{inicio}{aviso_db}\n\nVamos começar. {proxima}"})
+            return f"{inicio}{aviso_db}\n\nVamos começar. {proxima}"
         # caso tudo esteja preenchido, segue fluxo normal (sem perguntar novamente)
 
         proxima = ROTEIRO[0]["pergunta"]
         aviso_db = f"\n\n(Aviso: {msg_db})" if not ok_db else ""
-        return JSONResponse({"reply": f"{inicio}{aviso_db}\n\nVamos começar. {proxima}"})
+        return f"{inicio}{aviso_db}\n\nVamos começar. {proxima}"
 
     # === Continuação do roteiro ===
-    sess = SESSIONS.get(user_id)
+    sess = await SESSIONS.get(user_id)
     if sess and sess.get("started"):
         step = int(sess.get("step", 0))
         if step < len(ROTEIRO):
+            set_turn_stage(f"roteiro_{step + 1}" if step + 1 < len(ROTEIRO) else "diagnosis")
             # grava resposta do passo atual (se não é o primeiro prompt)
             key = ROTEIRO[step]["key"]
             sess["answers"][key] = raw.strip()
             step += 1
             sess["step"] = step
-            SESSIONS[user_id] = sess
 
             if step < len(ROTEIRO):
-                return JSONResponse({"reply": ROTEIRO[step]["pergunta"]})
+                await SESSIONS.set(user_id, sess)
+                return ROTEIRO[step]["pergunta"]
 
             # Coletou tudo → 2ª chamada ao Flowise
             sess_email = sess.get("user_email", user_email)
             sess_name = sess.get("user_name", user_name)
-            valores, datas, ok_db, msg_db = get_latest_infos(sess_email)
-            ctx = format_profile_context(sess_email, sess_name, valores)
+            uctx = await load_user_context(sess_email)
+            valores, ok_db, msg_db = uctx.valores, uctx.ok_db, uctx.msg_db
             ans = sess.get("answers", {})
             resumo_pf = ans.get(INFO_TAGS_PF, "")
             resumo_pd = ans.get(INFO_TAGS_PD, "")
@@ -929,58 +3756,190 @@ async def api_message(req: Request):
             tarefas = ans.get(INFO_TAREFAS, "")
 
             
-            prompt2 = PROMPT_DIAGNOSIS.format(
-                resumo_pessoa=get_basic_profile(sess_email)[0] or "",
+            prompt2 = build_prompt(
+                "diagnosis", PROMPT_DIAGNOSIS,
+                resumo_pessoa=uctx.resumo_pessoa or "",
                 feedback=valores.get("output_feedback", "") or "",
                 pontos_fortes=resumo_pf or valores.get(INFO_TAGS_PF, ""),
                 pontos_desenvolvimento=resumo_pd or valores.get(INFO_TAGS_PD, ""),
                 resultado=tarefas,
                 objetivos=objetivos or valores.get(INFO_OBJETIVOS, ""),
-                historico_bot=get_historico_bot(sess_email) or "",
-                resumos_semanal=get_resumos_semanal(sess_email) or ""
+                historico_bot=uctx.historico_bot or "",
+                resumos_semanal=uctx.resumos_semanal or ""
             )
             from datetime import date
-            resumo_pessoa, cargo_pessoa, id_pessoa = get_basic_profile(sess_email)
-            sess_id_override = f"{id_pessoa or user_id}:{date.today().isoformat()}"
-            resposta = await call_flowise_with_session(prompt2, sess_id_override, sess_name, sess_email)
-
-            # guarda diagnóstico e pede as competências (não encerra a sessão)
-            sess["diagnosis"] = resposta
-            sess["await_competencies"] = True
-            SESSIONS[user_id] = sess
-
+            sess_id_override = f"{uctx.id_pessoa or user_id}:{date.today().isoformat()}"
             aviso_db = f"\n\n(Aviso: {msg_db})" if not ok_db else ""
             follow = (
-                "Diagnóstico inicial:\n\n" + resposta + aviso_db +
+                aviso_db +
                 "\n\nAgora, com o diagnóstico feito, escolha DUAS habilidades/competências para desenvolver neste ciclo "
                 "(separe por ponto e vírgula). Ex.: Comunicação; Pragmatismo"
             )
-            return JSONResponse({"reply": follow})
+            gen = Generation("diagnosis", user_id, prompt2, sess_id_override, sess_name, sess_email,
+                             prefix="Diagnóstico inicial:\n\n", suffix=follow, use_cache=not regenerate)
+            sess["pending"], sess["pending_at"] = asdict(gen), time.time()
+            await SESSIONS.set(user_id, sess)
+            return gen
 
 
     # === Fora de fluxo ===
-    return JSONResponse({"reply": "Escolha uma opção válida."})
+    return "Escolha uma opção válida."
+
+
+BUSY_REPLY = "Estou atendendo muitas pessoas agora. Tente novamente em alguns segundos."
+
+
+def _busy_response() -> JSONResponse:
+    return JSONResponse({"reply": BUSY_REPLY, "busy": True}, status_code=503, headers={"Retry-After": "5"})
+
+
+def _wants_job(payload: Any) -> bool:
+    if isinstance(payload, dict) and "async" in payload:
+        return bool(payload["async"])
+    return JOB_MODE
+
+
+async def _handle_message(req: Request):
+    try:
+        turn = await run_turn(*await _read_message(req))
+    except DBBusy:
+        return _busy_response()
+    if isinstance(turn, Generation):
+        try:
+            payload = await req.json()
+        except Exception:
+            payload = None
+        if _wants_job(payload):
+            try:
+                job = await enqueue_generation(turn)
+            except JobQueueFull:
+                return _busy_response()
+            return JSONResponse({**job.public(), "poll": f"/api/jobs/{job.id}"}, status_code=202)
+        flight = await start_generation(turn.prompt, turn.session_id, turn.user_name, turn.user_email,
+                                        use_cache=turn.use_cache, user_id=turn.user_id)
+        resposta = await flight.text()
+        await finish_generation(turn, resposta)
+        return JSONResponse({"reply": f"{turn.prefix}{resposta}{turn.suffix}"})
+    return JSONResponse({"reply": turn})
+
+
+@app.post("/api/message")
+async def api_message(req: Request):
+    started = time.perf_counter()
+    try:
+        return await _handle_message(req)
+    finally:
+        TURN_SECONDS.observe(time.perf_counter() - started, "message", _TURN_STAGE.get())
+
+
+@app.get("/api/jobs/{job_id}")
+async def api_job(job_id: str):
+    _prune_jobs()
+    data = await _load_job(job_id)
+    if data is None:
+        return JSONResponse({"error": "job não encontrado"}, status_code=404)
+    return data
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/api/message/stream")
+async def api_message_stream(req: Request):
+    # Mesmo fluxo de /api/message, entregue como Server-Sent Events:
+    # `token` {"text"} (N vezes) e `end` {} ao final.
+    started = time.perf_counter()
+    try:
+        turn = await run_turn(*await _read_message(req))
+    except DBBusy:
+        return _busy_response()
+    stage = _TURN_STAGE.get()
+
+    async def events():
+        try:
+            if not isinstance(turn, Generation):
+                yield _sse("token", {"text": turn})
+                yield _sse("end", {})
+                return
+            if turn.prefix:
+                yield _sse("token", {"text": turn.prefix})
+            parts: List[str] = []
+            flight = await start_generation(turn.prompt, turn.session_id, turn.user_name, turn.user_email,
+                                            stream=True, use_cache=turn.use_cache, user_id=turn.user_id)
+            async for chunk in flight.follow():
+                parts.append(chunk)
+                yield _sse("token", {"text": chunk})
+            await finish_generation(turn, "".join(parts))
+            if turn.suffix:
+                yield _sse("token", {"text": turn.suffix})
+            yield _sse("end", {})
+        finally:
+            TURN_SECONDS.observe(time.perf_counter() - started, "stream", stage)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _pool_samples() -> List[Tuple[Tuple[str, ...], float]]:
+    samples = []
+    for name, dsn in (("db", DATABASE_URL), ("db2", DATABASE_URL_RESUMO_SEMANAL)):
+        if dsn:
+            st = get_pool(dsn).stats()
+            samples += [((name, state), st[state]) for state in ("in_use", "idle", "max")]
+    return samples
+
+
+def _session_samples(field: str = "size") -> List[Tuple[Tuple[str, ...], float]]:
+    st = SESSIONS.stats()
+    return [((st["backend"],), st[field])] if field in st else []
+
+
+Gauge("pdi_db_pool_connections", "Conexões dos pools do PostgreSQL por estado", ("pool", "state"), _pool_samples)
+Gauge("pdi_db_executor_pending", "Consultas em execução ou na fila do executor do banco", (),
+      lambda: [((), db_executor_stats()["pending"])])
+Gauge("pdi_sessions", "Sessões do roteiro em memória (backend memory)", ("backend",), _session_samples)
+CollectedCounter("pdi_sessions_expired_total", "Sessões removidas por inatividade (SESSION_TTL)", ("backend",),
+                 lambda: _session_samples("expired"))
+CollectedCounter("pdi_sessions_evicted_total", "Sessões descartadas pelo teto LRU (SESSION_MAX_ENTRIES)", ("backend",),
+                 lambda: _session_samples("evicted_lru"))
+Gauge("pdi_flowise_inflight", "Chamadas ao Flowise em andamento e aguardando vaga", ("state",),
+      lambda: [(("active",), FLOWISE_ADMISSION.active), (("waiting",), FLOWISE_ADMISSION.waiting)])
+Gauge("pdi_flowise_breaker_open", "1 quando o circuit breaker do Flowise está aberto (0.5 = meio-aberto)", (),
+      lambda: [((), {"closed": 0, "half_open": 0.5, "open": 1}[FLOWISE_BREAKER.state])])
+Gauge("pdi_generations", "Gerações de diagnóstico/PDI (single-flight) por estado", ("state",),
+      lambda: [((k,), v) for k, v in flights_stats().items()])
+Gauge("pdi_jobs_queued", "Jobs aguardando worker", (), lambda: [((), jobs_stats()["queued"])])
+Gauge("pdi_profile_cache_entries", "Entradas no cache de perfil", (), lambda: [((), PROFILE_CACHE.stats()["size"])])
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 
 @app.get("/diag")
 async def diag():
-    url = FLOWISE_PREDICTION_URL or (f"{FLOWISE_URL.rstrip('/')}/api/v1/prediction/{FLOWISE_CHATFLOW_ID}" if FLOWISE_URL and FLOWISE_CHATFLOW_ID else "")
+    url = flowise_url() or ""
+    def _ping(dsn: str):
+        with get_pool(dsn).connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+                _ = cur.fetchone()
     db_ok = False; db_msg = ""
     if DATABASE_URL:
         try:
-            with psycopg2.connect(DATABASE_URL) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT 1;")
-                    _ = cur.fetchone()
+            await run_db(_ping, DATABASE_URL)
             db_ok = True; db_msg = "ok"
         except Exception as e:
             db_msg = f"erro: {e}"
     db2_ok = False; db2_msg = ""
     if DATABASE_URL_RESUMO_SEMANAL:
         try:
-            with psycopg2.connect(DATABASE_URL_RESUMO_SEMANAL) as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT 1;")
-                    _ = cur.fetchone()
+            await run_db(_ping, DATABASE_URL_RESUMO_SEMANAL)
             db2_ok = True; db2_msg = "ok"
         except Exception as e:
             db2_msg = f"erro: {e}"
@@ -995,6 +3954,20 @@ async def diag():
         "db2_configured": bool(DATABASE_URL_RESUMO_SEMANAL),
         "db2_ok": db2_ok,
         "db2_msg": db2_msg,
+        "info_table": ".".join(_INFO_TABLE) if _INFO_TABLE else None,
+        "flowise_breaker": FLOWISE_BREAKER.stats(),
+        "flowise_admission": FLOWISE_ADMISSION.stats(),
+        "flowise_flights": flights_stats(),
+        "prompt_cache": PROMPT_CACHE.stats() if PROMPT_CACHE is not None else None,
+        "context_snapshots": SNAPSHOTS.stats() if SNAPSHOTS is not None else None,
+        "jobs": jobs_stats(),
+        "sessions": SESSIONS.stats(),
+        "profile_cache": PROFILE_CACHE.stats(),
+        "db_executor": db_executor_stats(),
+        "db_pools": {
+            "db": get_pool(DATABASE_URL).stats() if DATABASE_URL else None,
+            "db2": get_pool(DATABASE_URL_RESUMO_SEMANAL).stats() if DATABASE_URL_RESUMO_SEMANAL else None,
+        },
         "deltas": {
             "DELTA_TEMPO_RESUMO": DELTA_TEMPO_RESUMO,
             "DELTA_TEMPO": DELTA_TEMPO,
@@ -1004,25 +3977,87 @@ async def diag():
 
 @app.get("/profile")
 async def profile(email: str = Query(default=DEFAULT_USER_EMAIL)):
-    valores, datas, ok_db, msg_db = get_latest_infos(email)
-    resumo_pessoa, cargo_pessoa, id_pessoa = get_basic_profile(email)
-    historico = get_historico_bot(email)
-    resumos_sem = get_resumos_semanal(email)
+    try:
+        uctx = await load_user_context(email)
+    except DBBusy:
+        return _busy_response()
     return {
-        "ok": ok_db,
-        "msg": msg_db,
+        "ok": uctx.ok_db,
+        "msg": uctx.msg_db,
         "email": email,
         "perfil": {
-            "resumo_pessoa": resumo_pessoa,
-            "cargo": cargo_pessoa,
-            "id": id_pessoa,
-            "historico_bot": historico,
-            "resumos_semanal": resumos_sem,
+            "resumo_pessoa": uctx.resumo_pessoa,
+            "cargo": uctx.cargo_pessoa,
+            "id": uctx.id_pessoa,
+            "historico_bot": uctx.historico_bot,
+            "resumos_semanal": uctx.resumos_semanal,
         },
-        "valores": valores,
-        "datas": {k: (str(v) if v else None) for k,v in datas.items()},
+        "valores": uctx.valores,
+        "datas": {k: (str(v) if v else None) for k,v in uctx.datas.items()},
     }
 
+@app.post("/profiles")
+async def profiles(req: Request):
+    # infos de vários emails (ex.: o time de um gestor) numa única consulta
+    try:
+        body = await req.json()
+    except Exception:
+        body = {}
+    emails = body.get("emails") if isinstance(body, dict) else None
+    if not isinstance(emails, list) or not all(isinstance(e, str) for e in emails):
+        return JSONResponse({"ok": False, "msg": 'envie {"emails": ["a@x.com", ...]}'}, status_code=400)
+    if len(emails) > DB_BULK_MAX_EMAILS:
+        return JSONResponse({"ok": False, "msg": f"no máximo {DB_BULK_MAX_EMAILS} emails por chamada"}, status_code=400)
+    try:
+        infos = await run_db(get_latest_infos_bulk, [e.strip() for e in emails])
+    except DBBusy:
+        return _busy_response()
+    return {
+        "ok": all(ok for _, _, ok, _ in infos.values()),
+        "perfis": {
+            email: {
+                "ok": ok,
+                "msg": msg,
+                "valores": valores,
+                "datas": {k: (str(v) if v else None) for k, v in datas.items()},
+            }
+            for email, (valores, datas, ok, msg) in infos.items()
+        },
+    }
+
+def _admin_denied(req: Request) -> Optional[JSONResponse]:
+    if not ADMIN_TOKEN:
+        return JSONResponse({"ok": False, "msg": "ADMIN_TOKEN não configurado"}, status_code=403)
+    if not secrets.compare_digest(req.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        return JSONResponse({"ok": False, "msg": "token inválido"}, status_code=403)
+    return None
+
+
+@app.post("/admin/cache/invalidate")
+async def admin_cache_invalidate(req: Request, email: str = Query(..., description="Email do usuário")):
+    denied = _admin_denied(req)
+    if denied:
+        return denied
+    return {"ok": True, "email": email, "removidos": invalidate_user_cache(email)}
+
+@app.get("/admin/db/diagnostics")
+async def admin_db_diagnostics(req: Request, email: Optional[str] = Query(default=None, description="Email de amostra"),
+                               plans: bool = Query(default=False, description="Inclui o plano completo de cada consulta")):
+    denied = _admin_denied(req)
+    if denied:
+        return denied
+    # fora do executor do banco: EXPLAIN ANALYZE pode passar do DB_CALL_TIMEOUT em tabelas grandes
+    return await asyncio.to_thread(db_diagnostics, email, False, plans)
+
+
+@app.post("/admin/db/indexes")
+async def admin_db_indexes(req: Request):
+    denied = _admin_denied(req)
+    if denied:
+        return denied
+    report = await asyncio.to_thread(db_diagnostics, None, True)
+    return {"ok": report.get("ok", False), "indexes": report.get("indexes", []), "missing_indexes": report.get("missing_indexes", [])}
+
 @app.get("/health")
 async def health():
     return PlainTextResponse("ok")